@@ -9,6 +9,7 @@ import numpy as np
 from tweezerlyze.simulation.experiment import Experiment
 from options import experiment_options
 from tweezerlyze.detection import DetectionBot
+from tweezerlyze.cache import get_reference_image
 from evaluation import getFidelity, getPSNR, getSNR
 from time import time
 import matplotlib.pyplot as plt
@@ -47,12 +48,8 @@ plots = True
 experiment_options['atom_options']['p_filling'] = 1
 experiment_options['tweezer_options']['n_sites'] = (1,1)
 
-expt_reference = Experiment(**experiment_options)
-expt_reference.load_atoms()
-expt_reference.image_atoms(imaging_time=1e5)
-
-reference_image = expt_reference.imaging.camera.crop_image(roi)
-np.save('atoms_reference.npy', reference_image)
+# rendered once per configuration, then read from the cache
+reference_image = get_reference_image(experiment_options, imaging_time=1e5, roi=roi, mode='photons')
 
 
 ##### SPARSE IMAGES #####
@@ -1 +1 @@
-from . import simulation, detection, sorting, tweezerbot
\ No newline at end of file
+from . import simulation, detection, sorting, tweezerbot, streaming, histograms, cache
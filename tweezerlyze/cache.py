@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of simulated images, lattice calibrations and likelihood tables,
+keyed by a hash of their inputs.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from .simulation.experiment import Experiment
+
+
+def get_canonical(value):
+    """
+    Converts options, seeds and arrays into plain JSON values that do not
+    depend on dict order or object identity, for hashing.
+    """
+    if isinstance(value, dict):
+        return {str(key): get_canonical(value[key]) for key in sorted(value, key=str)}
+    if isinstance(value, (list, tuple)):
+        return [get_canonical(v) for v in value]
+    if isinstance(value, np.random.SeedSequence):
+        return {'entropy': str(value.entropy), 'spawn_key': list(value.spawn_key)}
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return {'dtype': value.dtype.str, 'shape': list(value.shape), 'sha256': digest}
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, str) or value is None:
+        return value
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)):
+        # integral floats agree with equal ints, repr keeps every digit of the others
+        if float(value).is_integer():
+            return str(int(value))
+        return repr(float(value))
+    if hasattr(value, '__dict__'):
+        # e.g. species: their class and every attribute
+        return {'class': type(value).__name__, 'attributes': get_canonical(vars(value))}
+
+    raise Exception(f'Cannot hash values of type {type(value)}.')
+
+
+def get_hash(*values):
+    """
+    Returns a stable hex digest of options dicts, seeds and arrays.
+    """
+    canonical = json.dumps(get_canonical(list(values)), sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class Cache():
+    def __init__(self, directory=None, max_size=2**30):
+        """
+        Stores arrays, or dicts of arrays, on disk under content-derived keys,
+        evicting the least recently used entries once the total size exceeds
+        max_size bytes.
+
+        Parameters
+        ----------
+        directory : str, optional
+            Cache directory. The default is ~/.cache/tweezerlyze.
+        max_size : int, optional
+            Total size in bytes kept on disk. The default is 1 GiB.
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'tweezerlyze')
+
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, kind, *values):
+        """
+        Returns the key of an artifact of some kind, e.g. 'reference', computed
+        from everything it depends on.
+        """
+        return f'{kind}-{get_hash(*values)}'
+
+    def get_path(self, key):
+        for extension in ['.npy', '.npz']:
+            path = os.path.join(self.directory, key + extension)
+            if os.path.exists(path):
+                return path
+
+        return None
+
+    def load(self, key):
+        """
+        Returns the stored array or dict of arrays, or None on a miss.
+        """
+        path = self.get_path(key)
+        if path is None:
+            return None
+
+        # mark as recently used
+        os.utime(path)
+
+        if path.endswith('.npy'):
+            return np.load(path)
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    def save(self, key, value):
+        """
+        Stores an array or dict of arrays, then evicts old entries.
+        """
+        extension = '.npz' if isinstance(value, dict) else '.npy'
+        path = os.path.join(self.directory, key + extension)
+
+        # write to a temporary file first, so readers never see partial entries
+        temporary = os.path.join(self.directory, f'.{key}.{os.getpid()}.tmp')
+        with open(temporary, 'wb') as f:
+            if isinstance(value, dict):
+                np.savez(f, **value)
+            else:
+                np.save(f, value)
+        os.replace(temporary, path)
+
+        self.evict()
+
+    def get(self, key, compute):
+        """
+        Returns the entry under key, calling compute() and storing its result
+        on a miss.
+        """
+        value = self.load(key)
+        if value is None:
+            value = compute()
+            self.save(key, value)
+
+        return value
+
+    def get_size(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory)
+                   if name.endswith(('.npy', '.npz')))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        max_size.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(('.npy', '.npz')):
+                path = os.path.join(self.directory, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(('.npy', '.npz')):
+                os.remove(os.path.join(self.directory, name))
+
+
+def get_reference_image(options, imaging_time=1e5, seed=0, roi=None, mode='expected', cache=None):
+    """
+    Returns the image of a simulated experiment, e.g. the reference image
+    of testing/benchmark.py, rendering it only if no image of the same
+    options, seed, imaging time, roi and mode is cached.
+    """
+    def compute():
+        expt = Experiment(**options, seed=seed)
+        expt.load_atoms()
+        expt.image_atoms(imaging_time, mode=mode)
+        if roi is None:
+            return expt.imaging.camera.image
+        return expt.imaging.camera.crop_image(roi)
+
+    cache = Cache() if cache is None else cache
+    key = cache.get_key('reference', options, imaging_time, seed, roi, mode)
+
+    return cache.get(key, compute)
+
+
+def calibrate_lattice(bot, image, cache=None, **calibrate_kwargs):
+    """
+    Calibrates a DetectionBot from an image as DetectionBot.calibrate_lattice
+    does, reusing a cached calibration of the same image and settings.
+    """
+    def compute():
+        lattice_vectors, origin = bot.calibrate_lattice(image, **calibrate_kwargs)
+        return {'lattice_vectors': lattice_vectors, 'origin': origin}
+
+    cache = Cache() if cache is None else cache
+    key = cache.get_key('lattice', image, calibrate_kwargs)
+    calibration = cache.get(key, compute)
+
+    bot.reference_image = bot.normalize(image)
+    bot.reference_pixels = calibration['origin']
+    bot.reference_tuple = (0, 0)
+    bot.spacing = np.linalg.norm(calibration['lattice_vectors'], axis=0)
+    bot.set_lattice_vectors(calibration['lattice_vectors'])
+
+    return calibration['lattice_vectors'], calibration['origin']
+
+
+def get_camera_model(camera):
+    """
+    Returns the camera settings entering the noise model of
+    simulation.statistics.
+    """
+    names = ['sensitivity', 'single_pixel_noise', 'gain', 'signal_offset', 'dark_charge',
+             'clock_induced_charge_occurence', 'quantum_efficiency']
+
+    return {name: getattr(camera, name) for name in names}
+
+
+def set_likelihood_table(bot, camera, n_photons, sigma, cache=None, **table_kwargs):
+    """
+    Sets the likelihood tables of a DetectionBot as
+    DetectionBot.set_likelihood_table does, reusing cached tables of the same
+    camera model, photon number, lattice and site boxes.
+    """
+    def compute():
+        bot.set_likelihood_table(camera, n_photons, sigma, **table_kwargs)
+        return {
+            'tables': bot.likelihood_tables,
+            'starts': bot.likelihood_starts,
+            'bin_width': np.array(bot.likelihood_bin_width),
+            'groups': bot.likelihood_groups,
+            }
+
+    cache = Cache() if cache is None else cache
+    lattice = [bot.lattice_vectors, np.asarray(bot.reference_pixels, dtype=float), bot.reference_tuple]
+    key = cache.get_key('likelihood', get_camera_model(camera), n_photons, sigma, lattice, bot.box_args,
+                        table_kwargs)
+    tables = cache.get(key, compute)
+
+    bot.likelihood_tables = tables['tables']
+    bot.likelihood_starts = tables['starts']
+    bot.likelihood_bin_width = float(tables['bin_width'])
+    bot.likelihood_groups = tables['groups']
@@ -239,7 +239,7 @@ def depthSteckQuantum(species=cesium, wavelength=1064e-9, power=None, waist=None
         
         depths[transition] = f(omega_transition, omega_drive, linewidth, Jg, Je, I)
         
-    depth = np.sum(list(depths.values())) #J
+    depth = sum(depths.values()) #J
 
     # change energy unit
     depth = J_to_unit(depth, unit)
@@ -251,7 +251,7 @@ def depthSteckQuantum(species=cesium, wavelength=1064e-9, power=None, waist=None
 
 
 def trapDepth(power=None, waist=None, intensity=None, method='steck_quantum', **kwargs):
-    if not ((power and waist) or (intensity)):
+    if intensity is None and (power is None or waist is None):
         raise Exception('Must provide power and waist or intensity.')
         
     if method == 'grimm_classical':
@@ -17,6 +17,8 @@ class quantity(float):
     def __init__(self, value, unit):
         float.__init__(value)
         self.unit = unit
+    def __reduce__(self):
+        return (quantity, (float(self), self.unit))
 
 class Transition():
     def __init__(self, properties):
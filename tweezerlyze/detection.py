@@ -9,8 +9,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from math import sqrt
-from skimage.feature import blob_dog, blob_log
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import fft2, fftfreq, fftshift, rfft2, irfft2, next_fast_len
+from scipy.sparse import csr_matrix
+from skimage.feature import blob_dog, blob_log, peak_local_max
 from skimage.util import img_as_uint, img_as_ubyte, img_as_float
+from .simulation.statistics import get_count_components, get_log_density, get_psf_fraction
 
 
 class DetectionBot():
@@ -26,9 +30,56 @@ class DetectionBot():
         self.blob_pixels = None
         self.blob_indices = None
         self.spacing = None
+        self.lattice_vectors = None
+        self.inverse_lattice_vectors = None
         
         #boolean mask
         self.blob_mask = None
+        self.mask_buffer = None
+        self.dropped_blobs = None
+        
+        #fixed-lattice detection
+        self.site_shape = None
+        self.site_weights = None
+        self.site_signals = None
+        self.weight_args = None
+        self.weight_entries = None
+        self.weight_anchors = None
+        self.weight_reference = None
+        
+        #matched filter
+        self.filter_sigma = None
+        self.filter_shape = None
+        self.filter_fft_shape = None
+        self.filter_kernel_fft = None
+        self.filter_samples = None
+        self.filter_sites = None
+        
+        #box sums
+        self.box_args = None
+        self.box_shape = None
+        self.box_corners = None
+        self.box_areas = None
+        self.box_background = 0
+        self.integral_image = None
+        
+        #likelihood ratio tables
+        self.likelihood_args = None
+        self.likelihood_tables = None
+        self.likelihood_starts = None
+        self.likelihood_bin_width = None
+        self.likelihood_groups = None
+        
+        #per-site windows
+        self.window_args = None
+        self.window_shape = None
+        self.window_size = None
+        self.window_strides = None
+        self.window_indices = None
+        
+        #drift tracking
+        self.drift_residual = None
+        self.sites_reference = None
         
     def set_background(self, background):
         """
@@ -37,11 +88,30 @@ class DetectionBot():
         self.background = background
         
         
-    def set_spacing(self, spacing):
+    def set_spacing(self, spacing, angle=0):
+        """
+        Set the lattice spacing in px, and optionally the angle in rad of the
+        j axis, following Tweezers.get_position.
+        """
         if type(spacing) in [list, tuple]:
             spacing = np.array(spacing)
             
         self.spacing = spacing
+        
+        sx, sy = np.broadcast_to(spacing, (2,))
+        self.set_lattice_vectors([[sx, sy*np.sin(angle)],
+                                  [0, sy*np.cos(angle)]])
+        
+    def set_lattice_vectors(self, lattice_vectors):
+        """
+        Set the affine pixel-index transform used by every detection method.
+        Column k of lattice_vectors is the pixel displacement between
+        neighbouring sites along index k, so that
+        
+            pixels = reference_pixels + lattice_vectors @ (indices - reference_tuple)
+        """
+        self.lattice_vectors = np.array(lattice_vectors, dtype=float)
+        self.inverse_lattice_vectors = np.linalg.inv(self.lattice_vectors)
     
     def normalize(self, image, dtype='float'):
         image = image/np.max(image)
@@ -55,10 +125,14 @@ class DetectionBot():
         
     def get_blob_pixels(self, image, method='dog', min_sigma=1, max_sigma=1,
                   threshold=0.01, exclude_border=False, **blob_kwargs):
-        if method == 'dog':
+        if method == 'matched':
+            return self.get_matched_peaks(image, threshold=threshold, **blob_kwargs)
+        elif method == 'dog':
             blob_funct = blob_dog
         elif method == 'log':
             blob_funct = blob_log
+        else:
+            raise Exception(f'Invalid blob method {method}')
             
         blobs = blob_funct(image,
                            min_sigma=min_sigma,
@@ -95,6 +169,164 @@ class DetectionBot():
 
         self.reference_pixels = blobs[0]
         
+    def calibrate_lattice(self, image, min_spacing=2, n_iterations=3, max_residual=0.3,
+                          padding=4, **blob_kwargs):
+        """
+        Find the lattice vectors and origin from an image of a densely loaded
+        array, replacing set_spacing and set_reference.
+        
+        The two strongest non-collinear peaks of the image power spectrum give
+        an initial lattice, which is refined by a least-squares fit of
+        pixels = origin + lattice_vectors @ indices to all blob centers. Site
+        (0, 0) is placed at the smallest occupied indices.
+
+        Parameters
+        ----------
+        image : ndarray
+            Image of a densely loaded array, e.g. testing/atoms_filled.npy.
+        min_spacing : float, optional
+            Smallest lattice spacing in px considered in the power spectrum.
+            The default is 2.
+        n_iterations : int, optional
+            Number of index assignment and least-squares rounds. The default
+            is 3.
+        max_residual : float, optional
+            Blobs further than this fraction of the smallest spacing from their
+            site are left out of the fit. The default is 0.3.
+        padding : int, optional
+            Zero padding factor of the FFT, refining the initial estimate.
+            The default is 4.
+        **blob_kwargs
+            Passed to get_blob_pixels.
+
+        Returns
+        -------
+        lattice_vectors : ndarray
+            Pixel displacement per site along i (first column) and j (second
+            column).
+        origin : ndarray
+            Pixel position of site (0, 0).
+        """
+        image = self.normalize(image)
+        
+        # initial lattice from the power spectrum
+        shape = (padding*image.shape[0], padding*image.shape[1])
+        power = np.abs(fft2(image - np.mean(image), s=shape))**2
+        kx, ky = np.meshgrid(fftfreq(shape[0]), fftfreq(shape[1]), indexing='ij')
+        
+        # keep one half plane, between the array size and min_spacing
+        k = np.hypot(kx, ky)
+        band = (k > 2/np.min(image.shape)) & (k < 1/min_spacing) & ((kx > 0) | ((kx == 0) & (ky > 0)))
+        power = fftshift(np.where(band, power, 0))
+        kx, ky = fftshift(kx), fftshift(ky)
+        
+        peaks = peak_local_max(power, min_distance=padding, exclude_border=False)
+        if len(peaks) < 2:
+            raise Exception('Could not find lattice peaks in the power spectrum.')
+        
+        # refine each peak with a parabola through its log power neighbours
+        log_power = np.log(power + np.max(power)*1e-12)
+        reciprocal = []
+        for px, py in peaks[:20]:
+            shift = []
+            for lo, hi in [((px-1, py), ((px+1) % shape[0], py)), ((px, py-1), (px, (py+1) % shape[1]))]:
+                a, b, c = log_power[lo], log_power[px, py], log_power[hi]
+                shift.append(0.5*(a - c)/(a - 2*b + c) if a - 2*b + c < 0 else 0)
+            reciprocal.append([kx[px, py] + shift[0]/shape[0], ky[px, py] + shift[1]/shape[1]])
+        reciprocal = np.array(reciprocal)
+        
+        # strongest peak, then the strongest one not collinear with it
+        b1 = reciprocal[0]
+        sines = np.abs(reciprocal[:, 0]*b1[1] - reciprocal[:, 1]*b1[0])
+        sines /= np.linalg.norm(reciprocal, axis=1)*np.linalg.norm(b1)
+        if not np.any(sines > 0.3):
+            raise Exception('Could not find two independent lattice peaks in the power spectrum.')
+        b2 = reciprocal[np.argmax(sines > 0.3)]
+        
+        lattice_vectors = self.reduce_lattice_vectors(np.linalg.inv(np.array([b1, b2])))
+        
+        # refine with all blob centers
+        blobs, sizes = self.get_blob_pixels(image, **blob_kwargs)
+        if len(blobs) < 3:
+            raise Exception('Calibration image should contain at least three blobs.')
+        
+        blobs = self.get_centroids(image, blobs)
+        
+        # origin from the circular mean of fractional site coordinates
+        fractions = blobs @ np.linalg.inv(lattice_vectors).T
+        phases = np.angle(np.mean(np.exp(2j*np.pi*fractions), axis=0)) / (2*np.pi)
+        origin = lattice_vectors @ phases
+        
+        min_spacing = np.min(np.linalg.norm(lattice_vectors, axis=0))
+        for _ in range(n_iterations):
+            indices = np.round((blobs - origin) @ np.linalg.inv(lattice_vectors).T)
+            residuals = blobs - origin - indices @ lattice_vectors.T
+            inliers = np.linalg.norm(residuals, axis=1) < max_residual*min_spacing
+            if np.count_nonzero(inliers) < 3:
+                raise Exception('Too few blobs lie on the lattice to refine it.')
+            
+            design = np.column_stack([np.ones(np.count_nonzero(inliers)), indices[inliers]])
+            coefficients = np.linalg.lstsq(design, blobs[inliers], rcond=None)[0]
+            origin = coefficients[0]
+            lattice_vectors = coefficients[1:].T
+            
+        # put site (0, 0) at the smallest occupied indices
+        indices = np.round((blobs[inliers] - origin) @ np.linalg.inv(lattice_vectors).T)
+        origin = origin + lattice_vectors @ np.min(indices, axis=0)
+        
+        self.reference_image = image
+        self.reference_pixels = origin
+        self.reference_tuple = (0, 0)
+        self.spacing = np.linalg.norm(lattice_vectors, axis=0)
+        self.set_lattice_vectors(lattice_vectors)
+        
+        return lattice_vectors, origin
+    
+    def get_centroids(self, image, blobs, half_width=2):
+        """
+        Refine integer blob positions to the intensity centroid of the
+        background-subtracted pixels around them.
+        """
+        anchors = np.round(blobs).astype('int')
+        offsets = np.arange(-half_width, half_width+1)
+        xidx = np.clip(anchors[:, 0, np.newaxis, np.newaxis] + offsets[:, np.newaxis], 0, image.shape[0]-1)
+        yidx = np.clip(anchors[:, 1, np.newaxis, np.newaxis] + offsets, 0, image.shape[1]-1)
+        
+        weights = np.clip(image[xidx, yidx] - np.median(image), 0, None)
+        total = np.sum(weights, axis=(1, 2))
+        total[total == 0] = np.inf
+        
+        shift_x = np.sum(weights*offsets[:, np.newaxis], axis=(1, 2)) / total
+        shift_y = np.sum(weights*offsets, axis=(1, 2)) / total
+        
+        return anchors + np.column_stack([shift_x, shift_y])
+    
+    def reduce_lattice_vectors(self, lattice_vectors):
+        """
+        Returns the shortest basis of a 2D lattice, ordered and signed so that
+        the first vector lies closest to the i (row) axis with positive i
+        component, and the second has a positive j component.
+        """
+        a1, a2 = np.array(lattice_vectors, dtype=float).T
+        
+        # Lagrange-Gauss reduction
+        while True:
+            if np.dot(a1, a1) > np.dot(a2, a2):
+                a1, a2 = a2, a1
+            mu = np.round(np.dot(a1, a2)/np.dot(a1, a1))
+            if mu == 0:
+                break
+            a2 = a2 - mu*a1
+            
+        if abs(a1[0])/np.linalg.norm(a1) < abs(a2[0])/np.linalg.norm(a2):
+            a1, a2 = a2, a1
+        if a1[0] < 0:
+            a1 = -a1
+        if a2[1] < 0:
+            a2 = -a2
+            
+        return np.column_stack([a1, a2])
+    
     def get_blob_indices(self, blobs):
         if self.reference_pixels is None:
             raise Exception('Must call set_reference before acquiring atom indices.')
@@ -102,16 +334,550 @@ class DetectionBot():
         # pixel positions relative to reference tweezer, dropping blob size
         blobs_relative = blobs - self.reference_pixels
         
-        if self.spacing is None:
-            raise Exception('Must set spacng before acquiring atom indices.')
+        if self.lattice_vectors is None or self.inverse_lattice_vectors is None:
+            raise Exception('Must set spacing or calibrate the lattice before acquiring atom indices.')
         
-        blob_indices = np.round(blobs_relative/self.spacing).astype('int')
+        blob_indices = np.round(blobs_relative @ self.inverse_lattice_vectors.T).astype('int')
         
         # shift relative to reference_tuple
         blob_indices += np.array(self.reference_tuple)
         
         return blob_indices
     
+    def get_site_pixels(self, n_sites):
+        """
+        Returns the pixel position of every site in an (ni, nj) array as an
+        (ni*nj, 2) array, ordered so that it reshapes to n_sites.
+        """
+        if self.reference_pixels is None:
+            raise Exception('Must call set_reference before acquiring site pixels.')
+        
+        if self.lattice_vectors is None:
+            raise Exception('Must set spacing before acquiring site pixels.')
+        
+        ni, nj = n_sites
+        iarr, jarr = np.meshgrid(np.arange(ni), np.arange(nj), indexing='ij')
+        site_indices = np.stack([iarr.ravel(), jarr.ravel()], axis=1)
+        
+        # inverse of get_blob_indices
+        site_indices = site_indices - np.array(self.reference_tuple)
+        
+        return self.reference_pixels + site_indices @ self.lattice_vectors.T
+    
+    def set_site_weights(self, n_sites, sigma, shape=None, radius=None):
+        """
+        Precompute a sparse matrix holding one Gaussian aperture per tweezer,
+        so that a frame is classified by a single matrix-vector product
+        instead of a blob search.
+
+        Parameters
+        ----------
+        n_sites : tuple
+            Number of sites (ni, nj) in the array.
+        sigma : float or iterable of len 2
+            Width of the point spread function in px.
+        shape : tuple, optional
+            Shape of the frames to be classified. The default is the shape of
+            the reference image.
+        radius : int, optional
+            Half width of the square aperture in px. The default is twice
+            sigma, rounded up.
+        """
+        if shape is None:
+            if self.reference_image is None:
+                raise Exception('Must provide shape or call set_reference before setting site weights.')
+            shape = self.reference_image.shape
+        
+        sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (2,))
+        if radius is None:
+            radius = int(np.ceil(2*np.max(sigma)))
+        
+        centers = self.get_site_pixels(n_sites)
+        anchors = np.round(centers).astype('int')
+        
+        # pixel coordinates of every aperture, one row per site
+        offsets = np.arange(-radius, radius+1)
+        dx, dy = np.meshgrid(offsets, offsets, indexing='ij')
+        px = anchors[:, 0, np.newaxis] + dx.ravel()
+        py = anchors[:, 1, np.newaxis] + dy.ravel()
+        
+        in_bounds = (px >= 0) & (px < shape[0]) & (py >= 0) & (py < shape[1])
+        rows = np.broadcast_to(np.arange(len(centers))[:, np.newaxis], px.shape)
+        columns = px*shape[1] + py
+        indptr = np.concatenate([[0], np.cumsum(np.count_nonzero(in_bounds, axis=1))])
+        
+        # sparsity pattern is fixed here, the weights are filled in by
+        # update_site_weights so they can follow drifts of the lattice
+        self.site_weights = csr_matrix((np.zeros(indptr[-1], dtype='float32'), columns[in_bounds], indptr),
+                                       shape=(len(centers), shape[0]*shape[1]))
+        self.weight_args = (tuple(n_sites), sigma, tuple(shape), radius)
+        self.weight_entries = (rows[in_bounds], px[in_bounds], py[in_bounds])
+        self.weight_anchors = anchors
+        self.weight_reference = np.copy(self.reference_pixels)
+        self.site_shape = tuple(n_sites)
+        
+        self.update_site_weights()
+        
+    def update_site_weights(self):
+        """
+        Recompute the aperture weights in place for the current site
+        positions, keeping the sparsity pattern of set_site_weights.
+        """
+        n_sites, sigma, shape, radius = self.weight_args
+        rows, px, py = self.weight_entries
+        centers = self.get_site_pixels(n_sites)
+        
+        # gaussian weights normalized over the full aperture, so sites
+        # clipped by the frame edge keep the same absolute scale
+        offsets = np.arange(-radius, radius+1)
+        fractions = (self.weight_anchors - centers) / sigma
+        norm_x = np.sum(np.exp(-0.5*(fractions[:, 0, np.newaxis] + offsets/sigma[0])**2), axis=1)
+        norm_y = np.sum(np.exp(-0.5*(fractions[:, 1, np.newaxis] + offsets/sigma[1])**2), axis=1)
+        
+        rx = (px - centers[rows, 0]) / sigma[0]
+        ry = (py - centers[rows, 1]) / sigma[1]
+        self.site_weights.data[:] = np.exp(-0.5*(rx**2 + ry**2)) / (norm_x*norm_y)[rows]
+        
+    def set_matched_filter(self, sigma, shape=None, n_sites=None, radius=None):
+        """
+        Build the matched filter for a gaussian point spread function and
+        cache its FFT for the frame shape, so each frame costs one real FFT
+        convolution.
+
+        Parameters
+        ----------
+        sigma : float or iterable of len 2
+            Width of the point spread function in px, e.g. from
+            Experiment.get_psf_sigma.
+        shape : tuple, optional
+            Shape of the frames to be filtered. The default is the shape of
+            the reference image.
+        n_sites : tuple, optional
+            Number of sites (ni, nj). If given, the filtered image is sampled
+            at every site by get_site_signals(method='matched').
+        radius : int, optional
+            Half width of the kernel in px. The default is three times sigma,
+            rounded up.
+        """
+        if shape is None:
+            if self.reference_image is None:
+                raise Exception('Must provide shape or call set_reference before setting matched filter.')
+            shape = self.reference_image.shape
+            
+        sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (2,))
+        if radius is None:
+            radius = int(np.ceil(3*np.max(sigma)))
+        
+        # pad so the circular convolution does not wrap around the edges
+        fft_shape = (next_fast_len(shape[0] + radius, real=True),
+                     next_fast_len(shape[1] + radius, real=True))
+        
+        # normalized kernel centered on the origin
+        offsets = np.arange(-radius, radius+1)
+        dx, dy = np.meshgrid(offsets, offsets, indexing='ij')
+        kernel = np.exp(-0.5*((dx/sigma[0])**2 + (dy/sigma[1])**2))
+        kernel /= np.sum(kernel)
+        
+        padded = np.zeros(fft_shape, dtype='float32')
+        padded[dx, dy] = kernel
+        
+        self.filter_sigma = sigma
+        self.filter_shape = tuple(shape)
+        self.filter_fft_shape = fft_shape
+        self.filter_kernel_fft = rfft2(padded)
+        
+        if n_sites is not None:
+            self.set_filter_samples(n_sites)
+            
+    def set_filter_samples(self, n_sites):
+        """
+        Set up bilinear sampling of the filtered image at every site.
+        """
+        centers = self.get_site_pixels(n_sites)
+        corners = np.clip(np.floor(centers).astype('int'), 0, np.array(self.filter_shape) - 2)
+        fractions = np.clip(centers - corners, 0, 1)
+        
+        self.filter_samples = (corners[:, 0], corners[:, 1], fractions.astype('float32'))
+        self.filter_sites = tuple(n_sites)
+        self.site_shape = tuple(n_sites)
+    
+    def get_filtered_image(self, image):
+        """
+        Returns an (H, W) frame or (n_frames, H, W) stack convolved with the
+        matched filter.
+        """
+        if self.filter_kernel_fft is None:
+            raise Exception('Must call set_matched_filter before filtering images.')
+            
+        image = np.asarray(image, dtype='float32')
+        if image.shape[-2:] != self.filter_shape:
+            raise Exception(f'Image shape {image.shape[-2:]} does not match filter shape {self.filter_shape}')
+        
+        spectrum = rfft2(image, s=self.filter_fft_shape)
+        filtered = irfft2(spectrum * self.filter_kernel_fft, s=self.filter_fft_shape)
+        
+        return filtered[..., :self.filter_shape[0], :self.filter_shape[1]]
+    
+    def get_matched_peaks(self, image, threshold=0.01, min_distance=None, **peak_kwargs):
+        """
+        Find blobs as local maxima of the matched-filtered image, with the
+        threshold measured above its median. Returns positions and sizes in
+        the same format as get_blob_pixels.
+        """
+        if min_distance is None:
+            min_distance = max(1, int(np.min(self.filter_sigma)))
+            
+        filtered = self.get_filtered_image(image)
+        filtered -= np.median(filtered)
+        
+        positions = peak_local_max(filtered,
+                                   min_distance=min_distance,
+                                   threshold_abs=threshold,
+                                   exclude_border=False,
+                                   **peak_kwargs).astype('float')
+        sizes = np.full(len(positions), np.max(self.filter_sigma) * sqrt(2))
+        
+        return positions, sizes
+    
+    def set_site_boxes(self, n_sites, half_width, shape=None, background=0):
+        """
+        Precompute a square box around every site, so that aperture sums can
+        be read from the integral image of a raw camera frame in O(1) per site.
+
+        Parameters
+        ----------
+        n_sites : tuple
+            Number of sites (ni, nj) in the array.
+        half_width : int
+            Boxes span 2*half_width + 1 px on each side, clipped at the frame
+            edge.
+        shape : tuple, optional
+            Shape of the frames to be classified. The default is the shape of
+            the reference image.
+        background : float, optional
+            Per-pixel baseline in camera counts, e.g. the camera signal offset,
+            subtracted from every box sum. The default is 0.
+        """
+        if shape is None:
+            if self.reference_image is None:
+                raise Exception('Must provide shape or call set_reference before setting site boxes.')
+            shape = self.reference_image.shape
+            
+        anchors = np.round(self.get_site_pixels(n_sites)).astype('int')
+        
+        x0 = np.clip(anchors[:, 0] - half_width, 0, shape[0])
+        x1 = np.clip(anchors[:, 0] + half_width + 1, 0, shape[0])
+        y0 = np.clip(anchors[:, 1] - half_width, 0, shape[1])
+        y1 = np.clip(anchors[:, 1] + half_width + 1, 0, shape[1])
+        
+        self.box_args = (tuple(n_sites), half_width, tuple(shape), background)
+        self.box_shape = tuple(shape)
+        self.box_corners = (x0, x1, y0, y1)
+        self.box_areas = ((x1 - x0)*(y1 - y0)).reshape(n_sites)
+        self.box_background = background
+        self.integral_image = np.zeros((shape[0]+1, shape[1]+1), dtype='int64')
+        self.site_shape = tuple(n_sites)
+        
+    def get_integral_image(self, image):
+        """
+        Returns the summed-area table of an (H, W) frame or (n_frames, H, W)
+        stack, padded with a leading row and column of zeros. Single frames
+        are written into a preallocated buffer that is reused by the next
+        call.
+        """
+        image = np.asarray(image)
+        
+        if image.ndim == 2 and self.integral_image is not None and image.shape == self.box_shape:
+            integral = self.integral_image
+        else:
+            integral = np.zeros(image.shape[:-2] + (image.shape[-2]+1, image.shape[-1]+1), dtype='int64')
+            
+        # the widening cumsum runs along the contiguous axis, which is faster
+        np.cumsum(image, axis=-1, dtype='int64', out=integral[..., 1:, 1:])
+        np.cumsum(integral[..., 1:, 1:], axis=-2, out=integral[..., 1:, 1:])
+        
+        return integral
+    
+    def get_box_signals(self, image):
+        """
+        Returns the box sum of every site in camera counts above the
+        background, for an (H, W) frame or (n_frames, H, W) stack.
+        """
+        if self.box_corners is None:
+            raise Exception('Must call set_site_boxes before acquiring box signals.')
+            
+        image = np.asarray(image)
+        if image.shape[-2:] != self.box_shape:
+            raise Exception(f'Image shape {image.shape[-2:]} does not match box shape {self.box_shape}')
+        
+        integral = self.get_integral_image(image)
+        x0, x1, y0, y1 = self.box_corners
+        
+        sums = (integral[..., x1, y1] - integral[..., x0, y1]
+                - integral[..., x1, y0] + integral[..., x0, y0])
+        sums = sums.reshape(image.shape[:-2] + self.site_shape)
+        
+        if self.box_background:
+            return sums - self.box_background*self.box_areas
+        
+        return sums
+    
+    def set_likelihood_table(self, camera, n_photons, sigma, bin_width=None, n_std=8,
+                             decimals=4, block_size=256):
+        """
+        Precompute, for every site box from set_site_boxes, a lookup table of
+        the log likelihood ratio between an occupied and an empty site as a
+        function of its box sum, using the EMCCD noise model of the simulated
+        camera. Every frame is then classified by one table gather.
+        
+        Sites whose boxes hold the same number of pixels and the same fraction
+        of the point spread function share a table.
+
+        Parameters
+        ----------
+        camera : IxonUltra888
+            Camera whose settings and noise model describe the frames.
+        n_photons : float
+            Mean number of photons reaching the camera from one atom, e.g.
+            from Experiment.get_n_photons.
+        sigma : float or iterable of len 2
+            Width of the point spread function in px.
+        bin_width : float, optional
+            Width of the table bins in counts. The default is a quarter of
+            the readout noise of a box, and at least 1.
+        n_std : float, optional
+            Tables span this many standard deviations below the empty and
+            above the occupied count distributions. The default is 8.
+        decimals : int, optional
+            Decimals of the PSF fraction used to group sites. The default is
+            4.
+        block_size : int, optional
+            Number of bins evaluated at once. The default is 256.
+        """
+        if self.box_corners is None:
+            raise Exception('Must call set_site_boxes before setting likelihood tables.')
+        
+        n_sites = self.box_args[0]
+        fractions = get_psf_fraction(self.get_site_pixels(n_sites), self.box_corners, sigma)
+        areas = np.ravel(self.box_areas)
+        
+        keys = np.column_stack([areas, np.round(fractions, decimals)])
+        keys, groups = np.unique(keys, axis=0, return_inverse=True)
+        
+        empty = get_count_components(camera, 0, keys[:, 1], keys[:, 0])
+        occupied = get_count_components(camera, n_photons, keys[:, 1], keys[:, 0])
+        std = empty[2]
+        
+        if bin_width is None:
+            bin_width = max(1, np.min(std)/4)
+        
+        # span from the empty background to the bright tail of occupied sites
+        occupied_weights = np.exp(occupied[0])
+        occupied_mean = np.sum(occupied_weights*occupied[1], axis=-1)
+        occupied_std = np.sqrt(np.sum(occupied_weights*(occupied[1] - occupied_mean[:, np.newaxis])**2, axis=-1) + std**2)
+        start = np.min(empty[1], axis=-1) - n_std*std
+        stop = occupied_mean + n_std*occupied_std
+        n_bins = int(np.ceil(np.max(stop - start)/bin_width))
+        
+        tables = np.empty((len(keys), n_bins), dtype='float32')
+        for g in range(len(keys)):
+            for b in range(0, n_bins, block_size):
+                counts = start[g] + (np.arange(b, min(b + block_size, n_bins)) + 0.5)*bin_width
+                tables[g, b:b + block_size] = (get_log_density(counts, occupied[0][g], occupied[1][g], occupied[2][g])
+                                               - get_log_density(counts, empty[0][g], empty[1][g], empty[2][g]))
+        
+        # tables are indexed by box signals, which exclude the background
+        self.likelihood_args = (camera, n_photons, sigma, bin_width, n_std, decimals, block_size)
+        self.likelihood_tables = tables
+        self.likelihood_starts = start - self.box_background*keys[:, 0]
+        self.likelihood_bin_width = bin_width
+        self.likelihood_groups = groups.ravel()
+        
+    def get_likelihood_signals(self, image):
+        """
+        Returns the log likelihood ratio of every site being occupied rather
+        than empty, for an (H, W) frame or (n_frames, H, W) stack. Classify
+        with a threshold of log((1 - p)/p) for a loading probability p, i.e.
+        0 for half filling.
+        """
+        if self.likelihood_tables is None:
+            raise Exception('Must call set_likelihood_table before acquiring likelihood signals.')
+        
+        signals = self.get_box_signals(image)
+        signals = signals.reshape(signals.shape[:-2] + (-1,))
+        
+        bins = (signals - self.likelihood_starts[self.likelihood_groups]) // self.likelihood_bin_width
+        bins = np.clip(bins, 0, self.likelihood_tables.shape[1] - 1).astype('int')
+        ratios = self.likelihood_tables[self.likelihood_groups, bins]
+        
+        return ratios.reshape(np.shape(image)[:-2] + self.site_shape)
+    
+    def set_site_windows(self, n_sites, half_width, shape=None):
+        """
+        Prepare (2*half_width + 1) px square windows around every site for
+        get_site_windows. If the lattice is aligned to the pixel grid and every
+        window lies inside the frame, windows are strided views into the
+        frame, otherwise they are gathered with precomputed indices.
+        """
+        if shape is None:
+            if self.reference_image is None:
+                raise Exception('Must provide shape or call set_reference before setting site windows.')
+            shape = self.reference_image.shape
+            
+        centers = self.get_site_pixels(n_sites)
+        anchors = np.round(centers).astype('int')
+        size = 2*half_width + 1
+        
+        starts = anchors - half_width
+        steps = np.round(np.diag(self.lattice_vectors)).astype('int')
+        
+        aligned = (np.allclose(centers, anchors)
+                   and np.allclose(self.lattice_vectors, np.diag(steps))
+                   and np.all(steps > 0)
+                   and np.all(starts >= 0)
+                   and np.all(starts + size <= np.array(shape)))
+        
+        if aligned:
+            self.window_strides = (tuple(starts[0]), tuple(steps))
+            self.window_indices = None
+        else:
+            offsets = np.arange(-half_width, half_width+1)
+            xidx = np.clip(anchors[:, 0, np.newaxis] + offsets, 0, shape[0]-1)
+            yidx = np.clip(anchors[:, 1, np.newaxis] + offsets, 0, shape[1]-1)
+            self.window_indices = (xidx.reshape(tuple(n_sites) + (size, 1)),
+                                   yidx.reshape(tuple(n_sites) + (1, size)))
+            self.window_strides = None
+            
+        self.window_args = (tuple(n_sites), half_width, tuple(shape))
+        self.window_shape = tuple(shape)
+        self.window_size = (size, size)
+        self.site_shape = tuple(n_sites)
+        
+    def get_site_windows(self, image):
+        """
+        Returns the pixels around every site of an (H, W) frame or
+        (n_frames, H, W) stack as an array of shape (..., ni, nj, h, w), so
+        per-site statistics are single reductions over the last two axes.
+        For pixel-aligned lattices this is a read-only view into image.
+        """
+        if self.window_shape is None:
+            raise Exception('Must call set_site_windows before acquiring site windows.')
+        
+        image = np.asarray(image)
+        if image.shape[-2:] != self.window_shape:
+            raise Exception(f'Image shape {image.shape[-2:]} does not match window shape {self.window_shape}')
+        
+        if self.window_strides is None:
+            xidx, yidx = self.window_indices
+            return image[..., xidx, yidx]
+        
+        (x0, y0), (sx, sy) = self.window_strides
+        ni, nj = self.site_shape
+        windows = sliding_window_view(image, self.window_size, axis=(-2, -1))
+        
+        return windows[..., x0:x0 + ni*sx:sx, y0:y0 + nj*sy:sy, :, :]
+    
+    def get_site_signals(self, image, method='weights'):
+        """
+        Returns the signal of every site, in image units. The image may be a
+        single (H, W) frame or an (n_frames, H, W) stack, giving signals of
+        shape n_sites or (n_frames, ni, nj).
+        
+        With method='weights' the signal is the aperture sum from
+        set_site_weights, with method='matched' it is the matched-filtered
+        image sampled at each site, as set up by set_matched_filter, and with
+        method='box' it is the box sum in camera counts from set_site_boxes,
+        and with method='likelihood' it is the log likelihood ratio from
+        set_likelihood_table.
+        """
+        if method == 'weights':
+            return self.get_weighted_signals(image)
+        elif method == 'matched':
+            return self.get_matched_signals(image)
+        elif method == 'box':
+            return self.get_box_signals(image)
+        elif method == 'likelihood':
+            return self.get_likelihood_signals(image)
+        else:
+            raise Exception(f'Invalid site method {method}')
+        
+    def get_weighted_signals(self, image):
+        if self.site_weights is None:
+            raise Exception('Must call set_site_weights before acquiring site signals.')
+        
+        image = np.asarray(image)
+        n_pixels = self.site_weights.shape[1]
+        
+        if image.ndim == 2:
+            signals = self.site_weights @ image.reshape(n_pixels)
+        else:
+            frames = image.reshape(-1, n_pixels)
+            signals = (self.site_weights @ frames.T).T
+        
+        return signals.reshape(image.shape[:-2] + self.site_shape)
+    
+    def get_matched_signals(self, image):
+        if self.filter_samples is None:
+            raise Exception('Must call set_matched_filter with n_sites before acquiring site signals.')
+            
+        filtered = self.get_filtered_image(image)
+        i, j, fractions = self.filter_samples
+        fx, fy = fractions.T
+        
+        signals = (filtered[..., i, j]*(1-fx)*(1-fy) + filtered[..., i+1, j]*fx*(1-fy)
+                   + filtered[..., i, j+1]*(1-fx)*fy + filtered[..., i+1, j+1]*fx*fy)
+        
+        return signals.reshape(np.shape(image)[:-2] + self.site_shape)
+    
+    def get_site_masks(self, frames, threshold, chunk_size=1024, method='weights'):
+        """
+        Classify every site in a stack of frames.
+
+        Parameters
+        ----------
+        frames : ndarray
+            Frames of shape (n_frames, H, W). Memory-mapped stacks, e.g. from
+            np.load(..., mmap_mode='r'), are read chunk by chunk.
+        threshold : float or ndarray
+            Signal threshold in image units, either global or per site.
+        chunk_size : int, optional
+            Number of frames classified at once. The default is 1024.
+        method : str, optional
+            Site signal method passed to get_site_signals. The default is
+            'weights'.
+
+        Returns
+        -------
+        masks : ndarray
+            Boolean occupancies of shape (n_frames, ni, nj).
+        signals : ndarray
+            Site signals of shape (n_frames, ni, nj).
+        """
+        if self.site_shape is None:
+            raise Exception('Must set up a site method before classifying frames.')
+        
+        n_frames = len(frames)
+        signals = np.empty((n_frames,) + self.site_shape, dtype='float32')
+        
+        for start in range(0, n_frames, chunk_size):
+            stop = min(start + chunk_size, n_frames)
+            signals[start:stop] = self.get_site_signals(frames[start:stop], method=method)
+            
+        masks = signals > threshold
+        
+        return masks, signals
+    
+    def set_site_mask(self, image, threshold, method='weights'):
+        """
+        Classify every site of a frame by thresholding its site signal,
+        skipping the blob search entirely.
+        """
+        self.image = image
+        self.site_signals = self.get_site_signals(image, method=method)
+        self.blob_mask = self.site_signals > threshold
+        
+        return self.blob_mask
+    
     def set_blobs(self, image, **blob_kwargs):
         image = self.normalize(image)
         self.image = image
@@ -122,19 +888,134 @@ class DetectionBot():
             
         return self.blob_pixels
         
-    def set_blob_mask(self, n_sites):
+    def get_in_bounds(self, blob_indices, n_sites):
+        """
+        Returns a boolean array marking which blob indices lie inside an
+        (ni, nj) array. Negative indices count as out of bounds.
+        """
+        blob_indices = np.asarray(blob_indices).reshape(-1, 2)
+        
+        return np.all((blob_indices >= 0) & (blob_indices < np.array(n_sites)), axis=1)
+        
+    def set_blob_mask(self, n_sites, out=None):
+        """
+        Scatter the blob indices into a boolean mask of shape n_sites. Blobs
+        outside the array are dropped and their positions in blob_pixels are
+        stored in dropped_blobs.
+        
+        Unless out is given, the mask is written into a buffer that is reused
+        by the next call, so copy blob_mask if it has to be kept.
+        """
         if self.blob_indices is None:
             raise Exception('Must call set_blobs before setting blob mask.')
+        
+        n_sites = tuple(n_sites)
+        if out is None:
+            if self.mask_buffer is None or self.mask_buffer.shape != n_sites:
+                self.mask_buffer = np.zeros(n_sites, dtype=bool)
+            out = self.mask_buffer
             
-        mask = np.zeros(n_sites)
-        for i, j in self.blob_indices:
-            try:
-                mask[i,j] = 1
-            except:
-                pass
+        in_bounds = self.get_in_bounds(self.blob_indices, n_sites)
+        i, j = self.blob_indices[in_bounds].T
+        
+        out[...] = False
+        out[i, j] = True
+        
+        self.dropped_blobs = np.flatnonzero(~in_bounds)
+        self.blob_mask = out
+        
+        return self.blob_mask
+    
+    def track_drift(self, blobs=None, image=None, mask=None, alpha=0.05, max_residual=0.3,
+                    tolerance=0.05, half_width=2):
+        """
+        Follow slow drifts of the tweezer grid from detected frames, without a
+        new reference shot.
+        
+        The median residual between atoms and their nearest sites is folded
+        into reference_pixels with an exponential moving filter. Residuals come
+        either from blob positions (by default blob_pixels from set_blobs), or
+        from the intensity centroids of the occupied sites in mask when an
+        image is given. Precomputed site weights, boxes, windows and filter
+        samples are shifted once the grid has moved by more than tolerance px.
+
+        Parameters
+        ----------
+        blobs : ndarray, optional
+            Blob pixel positions of shape (n_blobs, 2).
+        image : ndarray, optional
+            Frame whose occupied sites are given by mask.
+        mask : ndarray, optional
+            Boolean occupancies of shape n_sites, e.g. from set_site_mask.
+        alpha : float, optional
+            Weight of the newest residual in the moving filter. The default is
+            0.05.
+        max_residual : float, optional
+            Residuals longer than this fraction of the smallest spacing are
+            ignored. The default is 0.3.
+        tolerance : float, optional
+            Drift in px after which precomputed apertures are shifted. The
+            default is 0.05.
+        half_width : int, optional
+            Half width in px of the centroid windows. The default is 2.
+
+        Returns
+        -------
+        residual : ndarray
+            Median residual of this frame in px, or None if no atom was close
+            enough to a site.
+        """
+        if image is not None:
+            if mask is None:
+                mask = self.blob_mask
+            centers = self.get_site_pixels(np.shape(mask))[np.ravel(mask)]
+            residuals = self.get_centroids(np.asarray(image, dtype=float), centers, half_width) - centers
+        else:
+            if blobs is None:
+                blobs = self.blob_pixels
+            indices = self.get_blob_indices(blobs) - np.array(self.reference_tuple)
+            residuals = blobs - self.reference_pixels - indices @ self.lattice_vectors.T
+            
+        min_spacing = np.min(np.linalg.norm(self.lattice_vectors, axis=0))
+        residuals = residuals[np.linalg.norm(residuals, axis=1) < max_residual*min_spacing]
+        if len(residuals) == 0:
+            return None
+        
+        if self.sites_reference is None:
+            self.sites_reference = np.copy(self.reference_pixels)
+        
+        self.drift_residual = np.median(residuals, axis=0)
+        self.reference_pixels = self.reference_pixels + alpha*self.drift_residual
+        
+        if np.max(np.abs(self.reference_pixels - self.sites_reference)) > tolerance:
+            self.shift_sites()
             
-        self.blob_mask = mask.astype('bool')
+        return self.drift_residual
     
+    def shift_sites(self):
+        """
+        Move every precomputed site method to the current reference_pixels.
+        Site weights are recomputed in place while the grid stays within a
+        pixel of where they were built, and rebuilt otherwise. Likelihood
+        tables are rebuilt with the boxes.
+        """
+        if self.site_weights is not None:
+            if np.max(np.abs(self.reference_pixels - self.weight_reference)) < 1:
+                self.update_site_weights()
+            else:
+                self.set_site_weights(*self.weight_args)
+        if self.filter_samples is not None:
+            self.set_filter_samples(self.filter_sites)
+        if self.box_corners is not None:
+            self.set_site_boxes(*self.box_args)
+        if self.likelihood_tables is not None:
+            # box areas and PSF fractions change with the boxes
+            self.set_likelihood_table(*self.likelihood_args)
+        if self.window_shape is not None:
+            self.set_site_windows(*self.window_args)
+            
+        self.sites_reference = np.copy(self.reference_pixels)
+        
     def show_blobs(self, image=None, blobs=None, sizes=None, circles=False, text=True,
                    true_mask=None, title=None, cmap='gray'):
         if image is None:
@@ -158,14 +1039,11 @@ class DetectionBot():
                     i, j = self.blob_indices[idx]
                     
                     if true_mask is not None:
-                        try:
-                            if (i < 0) or (j < 0):
-                                color = 'red'
-                            elif true_mask[i,j] == self.blob_mask[i,j]:
-                                color = 'white'
-                            else:
-                                color = 'red'
-                        except:
+                        if not self.get_in_bounds((i, j), true_mask.shape)[0]:
+                            color = 'red'
+                        elif true_mask[i,j] == self.blob_mask[i,j]:
+                            color = 'white'
+                        else:
                             color = 'red'
                     else:
                         color = 'white'
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Per-site histograms of site signals, fitted to calibrate detection thresholds.
+"""
+
+import numpy as np
+from scipy.special import erfc, logsumexp
+
+
+def get_site_counts(shots, bot, method='box', chunk_size=1024):
+    """
+    Extracts the signal of every site from a stack of shots, as
+    DetectionBot.get_site_masks does.
+
+    Parameters
+    ----------
+    shots : ndarray
+        Shots of shape (n_shots, H, W), e.g. the stack saved by
+        testing/histograms.py. Memory-mapped stacks are read chunk by chunk.
+    bot : DetectionBot
+        Detection bot with the site method already set up.
+    method : str, optional
+        Site signal method passed to DetectionBot.get_site_signals. The
+        default is 'box'.
+    chunk_size : int, optional
+        Number of shots processed at once. The default is 1024.
+
+    Returns
+    -------
+    counts : ndarray
+        Site signals of shape (n_shots, ni, nj).
+
+    """
+    _, counts = bot.get_site_masks(shots, np.inf, chunk_size=chunk_size, method=method)
+
+    return counts
+
+
+def fit_bimodal(counts, n_iterations=500, tolerance=1e-8, min_std=None):
+    """
+    Fits an empty/occupied gaussian mixture to the counts of every site at
+    once, with expectation maximization vectorized over sites.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Site signals of shape (n_shots, ...), e.g. from get_site_counts.
+    n_iterations : int, optional
+        Maximum number of EM iterations. The default is 500.
+    tolerance : float, optional
+        Stop once no site's mean log likelihood changes by more than this.
+        The default is 1e-8.
+    min_std : float, optional
+        Lower bound on the component widths, keeping sites that never (or
+        always) load from collapsing. The default is 1e-3 of the spread of all
+        counts.
+
+    Returns
+    -------
+    fit : dict
+        Arrays of shape (2, ...) for 'weights', 'means' and 'stds', with the
+        empty component first, and the mean 'log_likelihood' per site.
+
+    """
+    counts = np.asarray(counts, dtype=float)
+    site_shape = counts.shape[1:]
+    x = counts.reshape(len(counts), -1)
+
+    if min_std is None:
+        min_std = 1e-3*(np.max(x) - np.min(x)) + 1e-12
+
+    # start from the lower and upper tails of each site's histogram
+    means = np.percentile(x, [10, 90], axis=0)
+    stds = np.full(means.shape, max(np.std(x)/4, min_std))
+    weights = np.full(means.shape, 0.5)
+    log_likelihood = np.full(x.shape[1], -np.inf)
+
+    for _ in range(n_iterations):
+        # E step, shape (2, n_shots, n_sites)
+        log_p = (np.log(weights) - np.log(stds))[:, np.newaxis] \
+                - 0.5*((x - means[:, np.newaxis])/stds[:, np.newaxis])**2
+        log_total = logsumexp(log_p, axis=0)
+        responsibilities = np.exp(log_p - log_total)
+
+        # M step
+        totals = np.sum(responsibilities, axis=1) + 1e-12
+        weights = totals / len(x)
+        means = np.sum(responsibilities*x, axis=1) / totals
+        variances = np.sum(responsibilities*(x - means[:, np.newaxis])**2, axis=1) / totals
+        stds = np.sqrt(np.maximum(variances, min_std**2))
+        weights = np.clip(weights, 1e-12, 1)
+
+        previous = log_likelihood
+        log_likelihood = np.mean(log_total, axis=0) - 0.5*np.log(2*np.pi)
+        if np.all(np.abs(log_likelihood - previous) < tolerance):
+            break
+
+    # empty component first
+    order = np.argsort(means, axis=0)
+    weights, means, stds = [np.take_along_axis(a, order, axis=0) for a in (weights, means, stds)]
+
+    return {
+        'weights': weights.reshape((2,) + site_shape),
+        'means': means.reshape((2,) + site_shape),
+        'stds': stds.reshape((2,) + site_shape),
+        'log_likelihood': log_likelihood.reshape(site_shape),
+        }
+
+
+def get_thresholds(fit):
+    """
+    Finds the threshold of every site where the weighted empty and occupied
+    gaussians cross, and the classification errors they leave.
+
+    Parameters
+    ----------
+    fit : dict
+        Mixture parameters as returned by fit_bimodal.
+
+    Returns
+    -------
+    thresholds : dict
+        Arrays of the site shape for 'threshold', 'false_positive' (empty
+        sites read as occupied), 'false_negative' (occupied sites read as
+        empty) and 'fidelity'. Error rates are fractions of all shots.
+
+    """
+    (w0, w1), (m0, m1), (s0, s1) = fit['weights'], fit['means'], fit['stds']
+
+    # w0 N(t; m0, s0) = w1 N(t; m1, s1) is a quadratic a t^2 + b t + c = 0
+    a = 0.5/s1**2 - 0.5/s0**2
+    b = m0/s0**2 - m1/s1**2
+    c = 0.5*m1**2/s1**2 - 0.5*m0**2/s0**2 + np.log(w0*s1/(w1*s0))
+
+    # numerically stable roots, which also cover equal widths (a = 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = -0.5*(b + np.sign(b)*np.sqrt(b**2 - 4*a*c))
+        roots = np.stack([q/a, c/q])
+
+    # keep the crossing closest to the midpoint between the means
+    midpoint = 0.5*(m0 + m1)
+    roots = np.where(np.isfinite(roots), roots, np.inf)
+    closest = np.argmin(np.abs(roots - midpoint), axis=0)
+    threshold = np.take_along_axis(roots, closest[np.newaxis], axis=0)[0]
+    threshold = np.where(np.isfinite(threshold), threshold, midpoint)
+
+    false_positive = w0*0.5*erfc((threshold - m0)/(np.sqrt(2)*s0))
+    false_negative = w1*0.5*erfc((m1 - threshold)/(np.sqrt(2)*s1))
+
+    return {
+        'threshold': threshold,
+        'false_positive': false_positive,
+        'false_negative': false_negative,
+        'fidelity': 1 - false_positive - false_negative,
+        }
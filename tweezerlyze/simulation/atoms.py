@@ -11,7 +11,7 @@ from ..calculation.unit_conversions import K_to_unit
 
 
 class Atoms():
-    def __init__(self, species, temperature, imaging_transition='D2'):
+    def __init__(self, species, temperature, imaging_transition='D2', rng=None):
         
         self.species = species
         self.temperature = temperature
@@ -24,44 +24,89 @@ class Atoms():
         self.photons_generated = False
         self.n_photons = None
         
-    def load_atoms(self, sites, filling_distribution, filling_distribution_kwargs={}):
-        n_sites = len(sites)
-        avg_filling = np.array([s.avg_filling for s in sites])
+        # random number generator for loading and fluorescence
+        self.rng = np.random.default_rng() if rng is None else rng
+        
+    def load_atoms(self, sites, filling_distribution, filling_distribution_kwargs={}, avg_filling=None,
+                   n_shots=None):
+        """
+        Load atoms into the tweezers by drawing an occupancy for every site.
+
+        Parameters
+        ----------
+        sites : Tweezers, list or ndarray
+            Either Tweezers, a list of Tweezer objects, or their positions
+            as an array of shape (2, n_sites), e.g. Tweezers.positions.
+        filling_distribution : str
+            Can be 'binomial', 'poisson' or 'normal'.
+        filling_distribution_kwargs : dict, optional
+            Passed to the numpy random generator of the filling distribution.
+        avg_filling : float or ndarray, optional
+            Mean occupancy of every site, when sites are given as positions.
+            The default is the avg_filling of the tweezers.
+        n_shots : int, optional
+            Draw this many independent loading realizations at once. The
+            default is a single realization.
+        """
+        if isinstance(sites, np.ndarray):
+            site_positions = sites
+            if avg_filling is None:
+                raise Exception('Must provide avg_filling when loading sites from positions.')
+        elif hasattr(sites, 'positions'):
+            site_positions = sites.positions
+            avg_filling = sites.avg_filling
+        else:
+            site_positions = np.array([site.position for site in sites]).T
+            avg_filling = [site.avg_filling for site in sites]
+        
+        n_sites = site_positions.shape[1]
+        avg_filling = np.broadcast_to(np.asarray(avg_filling, dtype=float), (n_sites,))
+        size = n_sites if n_shots is None else (n_shots, n_sites)
         
         # fill sites based on filling distribution
         if filling_distribution == 'binomial':
-            self.occupancies = np.random.binomial(1, avg_filling, size=n_sites, **filling_distribution_kwargs)
+            self.occupancies = self.rng.binomial(1, avg_filling, size=size, **filling_distribution_kwargs)
             
         elif filling_distribution == 'poisson':
-            self.occupancies = np.random.poisson(avg_filling, size=n_sites, **filling_distribution_kwargs)
+            self.occupancies = self.rng.poisson(avg_filling, size=size, **filling_distribution_kwargs)
         
         elif filling_distribution == 'normal':
-            self.occupancies = np.random.normal(avg_filling, size=n_sites, **filling_distribution_kwargs)
+            self.occupancies = self.rng.normal(avg_filling, size=size, **filling_distribution_kwargs)
             self.occupancies = np.clip(self.occupancies, 0, np.inf)
             self.occupancies = self.occupancies.astype('int')
         else:
             raise Exception(f'Invalid filling distribution {filling_distribution}')
-            
-            
-        site_positions = np.array([site.position for site in sites]).T
-            
-        self.occupied_positions = site_positions[:, self.occupancies > 0]
-        self.nonzero_occupancies = [o for o in self.occupancies if o != 0]
         
-        # record position of each atom
-        atom_positions = np.zeros((2,0))
-
-        for position, occupancy in zip(self.occupied_positions.T, self.nonzero_occupancies):
-            tmp = np.ones((2, occupancy))*position[:, np.newaxis]
-            atom_positions = np.concatenate((atom_positions, tmp), axis=1)
-            
-        self.atom_positions = atom_positions
+        # one entry per atom, listing the site (and shot) it was loaded into
+        occupancies = self.occupancies.reshape(-1, n_sites)
+        atom_sites = np.repeat(np.tile(np.arange(n_sites), len(occupancies)), occupancies.ravel())
+        
+        self.atom_sites = atom_sites
+        
+        occupied = occupancies > 0
+        self.occupied_positions = site_positions[:, np.nonzero(occupied)[1]]
+        self.nonzero_occupancies = occupancies[occupied]
+        self.atom_positions = site_positions[:, atom_sites]
+        self.atom_shots = np.repeat(np.arange(len(occupancies)), np.sum(occupancies, axis=1))
         
         self.atoms_generated = True
         
+    def get_atom_sigma(self, sigma):
+        """
+        Returns (x, y) widths of shape (2, 1), or (2, n_atoms) for widths
+        given per site as an array of shape (2, n_sites).
+        """
+        sigma = np.asarray(sigma, dtype=float)
+        if sigma.ndim == 2:
+            return sigma[:, self.atom_sites]
+        
+        return np.broadcast_to(sigma, (2,))[:, np.newaxis]
+        
     def generate_photons(self, scattering_rate, sigma_thermal, exposure_time, collection_efficiency=1):
         """
-        Generate fluorescence photons
+        Generate fluorescence photons. The thermal width is a scalar, an
+        (x, y) tuple or an array of shape (2, n_sites) with one column per
+        site.
         """
         
         # scattering rate and exposure give number of photons per atom, but we'll only generate as many as the imaging system would capture
@@ -72,16 +117,9 @@ class Atoms():
         photon_positions = np.transpose(photon_positions, axes=[1,2,0])
         
         #each photon is gaussian distributed according to thermal motion   
-        if type(sigma_thermal) == tuple:
-            (sigma_thermal_x, sigma_thermal_y) = sigma_thermal
-        else:
-            sigma_thermal_x = sigma_thermal
-            sigma_thermal_y = sigma_thermal
-        scale_template = np.ones(photon_positions.shape[1:])          
-        scale = np.array([sigma_thermal_x*scale_template, 
-                          sigma_thermal_y*scale_template])        
+        scale = self.get_atom_sigma(sigma_thermal)[:, :, np.newaxis]
         
-        photon_positions = np.random.normal(loc=photon_positions, scale=scale)
+        photon_positions = self.rng.normal(loc=photon_positions, scale=scale)
         xarr = photon_positions[0,:]
         yarr = photon_positions[1,:]
         self.photon_positions = np.stack([xarr.flatten(), yarr.flatten()])
@@ -90,6 +128,39 @@ class Atoms():
         
         return self.photon_positions
     
+    def generate_photon_chunks(self, scattering_rate, sigma_thermal, exposure_time, collection_efficiency=1,
+                               chunk_size=2**20, return_shots=False):
+        """
+        Generate the same fluorescence photons as generate_photons, but yield
+        them in arrays of shape (2, chunk_size) so that memory does not grow
+        with the number of photons.
+        
+        The thermal width is given as for generate_photons. With return_shots,
+        (photon_positions, shots) tuples are yielded instead, listing the
+        loading realization of every photon for atoms loaded with n_shots.
+        """
+        self.n_photons = int(exposure_time * scattering_rate * collection_efficiency)
+        
+        atom_positions = self.atom_positions
+        atom_shots = self.atom_shots
+        atom_sigma = self.get_atom_sigma(sigma_thermal)
+        n_total = atom_positions.shape[1] * self.n_photons
+        
+        for start in range(0, n_total, chunk_size):
+            emitters = np.arange(start, min(start + chunk_size, n_total)) // self.n_photons
+            photon_positions = atom_positions[:, emitters]
+            scale = atom_sigma if atom_sigma.shape[1] == 1 else atom_sigma[:, emitters]
+            
+            # each photon is gaussian distributed according to thermal motion
+            photon_positions += self.rng.normal(scale=scale, size=photon_positions.shape)
+            
+            if return_shots:
+                yield photon_positions, atom_shots[emitters]
+            else:
+                yield photon_positions
+        
+        self.photons_generated = True
+    
     def plot_atoms(self):
         """
         Visualize the atoms.
@@ -8,12 +8,145 @@ Created on Mon May 25 17:33:18 2020
 from . atoms import Atoms
 from . geometry import Tweezers
 from . imaging import Imaging
+from . lasers import Laser
+from . statistics import get_psf_fraction, predict_fidelity
 
 import numpy as np
 
+# peak bytes per photon while generating, diffracting and binning a chunk:
+# (x, y) float64 positions, thermal displacements and diffracted positions,
+# one float64 temporary while binning, and int64 emitter, shot, pixel i, j
+# and flat pixel indices, i.e. 96 bytes
+photon_bytes = (3*2 + 1)*np.dtype('float64').itemsize + 5*np.dtype('int64').itemsize
+
+# update steps of Experiment.update, in the order they run, with the steps
+# whose results they depend on. set_roi and set_scale refresh the pixel bins
+# themselves.
+update_dependencies = {
+    'species': [],
+    'temperature': [],
+    'sites': [],
+    'filling': [],
+    'tweezer_laser': [],
+    'trap_depth': ['species', 'sites', 'tweezer_laser'],
+    'sigma_thermal': ['temperature', 'tweezer_laser', 'trap_depth'],
+    'imaging_laser': [],
+    'magnification': [],
+    'aperture': [],
+    'diffraction': ['imaging_laser', 'aperture'],
+    'rates': ['aperture'],
+    'readout': [],
+    'dark_charge': [],
+    'gain': [],
+    'roi': [],
+    'scale': ['magnification'],
+    'position': [],
+    }
+
+# update steps that directly depend on an option
+option_steps = {
+    'atom_options.species': ['species'],
+    'atom_options.imaging_transition': ['species'],
+    'atom_options.temperature': ['temperature'],
+    'tweezer_options.n_sites': ['sites'],
+    'tweezer_options.spacing': ['sites'],
+    'tweezer_options.angle': ['sites'],
+    'tweezer_options.offset': ['sites'],
+    'tweezer_options.avg_filling': ['sites'],
+    'tweezer_options.layout': ['sites'],
+    'tweezer_options.target': ['sites'],
+    'tweezer_options.filling_distribution': ['filling'],
+    'tweezer_options.filling_distribution_kwargs': ['filling'],
+    'tweezer_options.wavelength': ['tweezer_laser'],
+    'tweezer_options.power': ['tweezer_laser'],
+    'tweezer_options.waist': ['tweezer_laser'],
+    'imaging_options.laser_options': ['imaging_laser'],
+    'imaging_options.optics_options.magnification': ['magnification'],
+    'imaging_options.optics_options.NA': ['aperture'],
+    'imaging_options.camera_options.pixel_size': ['scale'],
+    'imaging_options.camera_options.sensor_size': ['roi'],
+    'imaging_options.camera_options.roi': ['roi'],
+    'imaging_options.camera_options.crop_mode': ['roi'],
+    'imaging_options.camera_options.gain': ['gain'],
+    'imaging_options.camera_options.preamp_setting': ['readout'],
+    'imaging_options.camera_options.amplifier_type': ['readout'],
+    'imaging_options.camera_options.readout_rate': ['readout'],
+    'imaging_options.camera_options.sensor_temperature': ['dark_charge'],
+    'imaging_options.camera_options.exposure_time': ['dark_charge'],
+    'imaging_options.camera_options.position': ['position'],
+    'imaging_options.scattering_rate': ['rates'],
+    }
+
+
+def copy_options(options):
+    """
+    Returns a copy of nested option dicts, sharing the leaves (e.g. species).
+    """
+    if isinstance(options, dict):
+        return {key: copy_options(value) for key, value in options.items()}
+
+    return options
+
+
+def has_option(options, key):
+    """
+    Whether a dotted key such as 'imaging_options.camera_options.gain' names
+    an entry of nested option dicts.
+    """
+    for part in key.split('.'):
+        if not isinstance(options, dict) or part not in options:
+            return False
+        options = options[part]
+
+    return True
+
+
+def get_option(options, key):
+    """
+    Returns the entry of nested option dicts named by a dotted key, or None.
+    """
+    for part in key.split('.'):
+        if not isinstance(options, dict):
+            return None
+        options = options.get(part)
+
+    return options
+
+
+def set_option(options, key, value):
+    """
+    Sets the entry of nested option dicts named by a dotted key.
+    """
+    *parents, last = key.split('.')
+    for part in parents:
+        options = options[part]
+    options[last] = value
+
+
+def get_option_steps(key):
+    """
+    Returns the update steps that directly depend on the option named by a
+    dotted key, which may also name a whole options dict, e.g.
+    'imaging_options.camera_options'.
+    """
+    steps = []
+    for option in option_steps:
+        # the option itself, one of its entries, or the dict containing it
+        if option == key or option.startswith(key + '.') or key.startswith(option + '.'):
+            steps += option_steps[option]
+
+    if not steps:
+        raise Exception(f'Invalid option {key}')
+
+    return steps
+
 
 class Experiment:
-    def __init__(self, atom_options, tweezer_options, imaging_options):
+    def __init__(self, atom_options, tweezer_options, imaging_options, seed=None):
+        self.options = copy_options({'atom_options': atom_options,
+                                     'tweezer_options': tweezer_options,
+                                     'imaging_options': imaging_options})
+        
         self.atoms = Atoms(**atom_options)
         
         self.geometry = Tweezers(**tweezer_options)
@@ -22,25 +155,460 @@ class Experiment:
         
         self.imaging = Imaging(**imaging_options)
         self.imaging.set_rates(scattering_rate = imaging_options['scattering_rate'])
+        
+        self.set_seed(seed)
+        
+    def set_seed(self, seed=None):
+        """
+        Seed every random draw of the experiment. The seed can be anything
+        numpy.random.SeedSequence accepts, or a SeedSequence itself, e.g. one
+        of spawn_seeds. The default draws fresh entropy from the OS. The
+        count of shots for generate_shots starts again from 0.
+        """
+        if isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+        
+        # shot streams derive from the first child, spawned seeds from the others
+        self.shot_seed = self.get_child_seed(0)
+        self.shots_generated = 0
+        self.set_rng(np.random.default_rng(self.seed_sequence))
+        
+    def set_rng(self, rng):
+        """
+        Share one numpy.random.Generator between the atoms, optics and camera.
+        """
+        self.rng = rng
+        self.atoms.rng = rng
+        self.imaging.optics.rng = rng
+        self.imaging.camera.rng = rng
+        
+    def update(self, changes):
+        """
+        Change options of the experiment, recomputing only the quantities that
+        depend on them, e.g. a new readout rate only looks up the camera's
+        sensitivity and readout noise, while a new tweezer power recomputes
+        the trap depth and thermal width. All keys are checked before any
+        option changes, and if an update step fails the previous options are
+        restored and the exception is raised again. Loaded atoms are kept as
+        they are; call load_atoms to load them with the new options.
+
+        Parameters
+        ----------
+        changes : dict
+            Maps dotted keys, as for sweeps.run_sweep, e.g.
+            'imaging_options.camera_options.readout_rate', to new values.
+            A key may also name a whole options dict, which is replaced.
 
+        Returns
+        -------
+        steps : list
+            Names of the update steps that ran, in order, as listed in
+            update_dependencies.
+
+        """
+        # apply the changes to a copy, which replaces the options on success
+        options = copy_options(self.options)
+        changed = set()
+        for key, value in changes.items():
+            changed.update(get_option_steps(key))
+            parent = key.rpartition('.')[0]
+            if parent and not isinstance(get_option(options, parent), dict):
+                raise Exception(f'Invalid option {key}')
+            set_option(options, key, value)
+        
+        steps = []
+        for step, dependencies in update_dependencies.items():
+            if step in changed or changed.intersection(dependencies):
+                changed.add(step)
+                steps.append(step)
+        
+        self.options, options = options, self.options
+        try:
+            for step in steps:
+                getattr(self, f'update_{step}')()
+        except Exception:
+            # recompute everything from the previous options
+            self.options = options
+            for step in steps:
+                getattr(self, f'update_{step}')()
+            raise
+        
+        return steps
+    
+    def update_species(self):
+        atom_options = self.options['atom_options']
+        self.atoms.species = atom_options['species']
+        line = getattr(self.atoms.species, atom_options.get('imaging_transition', 'D2'))
+        self.atoms.wavelength = line.wavelength
+        
+    def update_temperature(self):
+        self.atoms.temperature = self.options['atom_options']['temperature']
+        
+    def update_sites(self):
+        tweezer_options = self.options['tweezer_options']
+        for name in ['n_sites', 'spacing', 'angle', 'offset', 'avg_filling']:
+            setattr(self.geometry, name, tweezer_options[name])
+        self.geometry.layout = tweezer_options.get('layout', 'rectangular')
+        self.geometry.target = tweezer_options.get('target')
+        
+        self.geometry.generate_sites()
+        self.geometry.occupancies = None
+        
+    def update_filling(self):
+        tweezer_options = self.options['tweezer_options']
+        self.geometry.filling_distribution = tweezer_options.get('filling_distribution', 'binomial')
+        self.geometry.filling_distribution_kwargs = tweezer_options.get('filling_distribution_kwargs', {})
+        
+    def update_tweezer_laser(self):
+        tweezer_options = self.options['tweezer_options']
+        self.geometry.set_laser(tweezer_options['wavelength'], tweezer_options['power'],
+                                tweezer_options['waist'])
+        
+    def update_trap_depth(self):
+        self.geometry.set_trap_depth(atoms=self.atoms)
+        
+    def update_sigma_thermal(self):
+        self.geometry.set_sigma_thermal(atoms=self.atoms)
+        
+    def update_imaging_laser(self):
+        self.imaging.laser = Laser(**self.options['imaging_options']['laser_options'])
+        
+    def update_magnification(self):
+        self.imaging.optics.magnification = self.options['imaging_options']['optics_options']['magnification']
+        
+    def update_aperture(self):
+        self.imaging.optics.set_NA(self.options['imaging_options']['optics_options']['NA'])
+        
+    def update_diffraction(self):
+        self.imaging.optics.set_diffraction(self.imaging.laser.wavelength)
+        
+    def update_rates(self):
+        self.imaging.set_rates(self.options['imaging_options'].get('scattering_rate'))
+        
+    def update_readout(self):
+        camera_options = self.options['imaging_options']['camera_options']
+        self.imaging.camera.set_readout(camera_options['preamp_setting'], camera_options['amplifier_type'],
+                                        camera_options['readout_rate'])
+        
+    def update_dark_charge(self):
+        camera_options = self.options['imaging_options']['camera_options']
+        self.imaging.camera.set_dark_charge(camera_options['sensor_temperature'], camera_options['exposure_time'])
+        
+    def update_gain(self):
+        self.imaging.camera.gain = self.options['imaging_options']['camera_options']['gain']
+        
+    def update_roi(self):
+        camera_options = self.options['imaging_options']['camera_options']
+        self.imaging.camera.sensor_size = camera_options['sensor_size']
+        self.imaging.camera.set_roi(camera_options.get('roi'), camera_options.get('crop_mode', False))
+        
+    def update_scale(self):
+        self.imaging.camera.pixel_size = self.options['imaging_options']['camera_options']['pixel_size']
+        self.imaging.camera.set_scale(self.imaging.optics.magnification)
+        
+    def update_position(self):
+        self.imaging.camera.position = self.options['imaging_options']['camera_options'].get('position', (0, 0))
+        self.imaging.camera.set_pixel_bins()
+        
+    def get_child_seed(self, key):
+        """
+        Returns the child SeedSequence of the seed with the given spawn key,
+        without advancing the seed, so equal seeds give equal children.
+        """
+        seed = self.seed_sequence
+        
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (key,))
+    
+    def spawn_seeds(self, n_seeds):
+        """
+        Returns n_seeds independent SeedSequences, e.g. to seed one copy of
+        the experiment per worker process. Every call returns the same
+        seeds.
+        """
+        return [self.get_child_seed(k + 1) for k in range(n_seeds)]
+    
+    def get_shot_rng(self, first_shot):
+        """
+        Returns the generator of the block of shots starting at shot
+        first_shot in generate_shots. It only depends on the seed and
+        first_shot, so blocks can be generated in any order or process.
+        """
+        seed = self.shot_seed
+        
+        return np.random.default_rng(np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (first_shot,)))
         
     def load_atoms(self):
-        self.atoms.load_atoms(self.geometry.sites, self.geometry.filling_distribution, self.geometry.filling_distribution_kwargs)
+        self.atoms.load_atoms(self.geometry.positions, self.geometry.filling_distribution,
+                              self.geometry.filling_distribution_kwargs, avg_filling=self.geometry.avg_filling)
         self.geometry.occupancies = self.atoms.occupancies
         self.geometry.set_gt_mask()
         
-    def image_atoms(self, imaging_time):
-        # generate fluorescence photons
-        photon_positions = self.atoms.generate_photons(self.imaging.collection_rate,
-                                                       self.geometry.sigma_thermal,
-                                                       imaging_time,
-                                                       self.imaging.optics.collection_efficiency)
+    def image_atoms(self, imaging_time, mode='photons', max_memory=2**28):
+        """
+        Image the loaded atoms onto the camera.
+
+        Parameters
+        ----------
+        imaging_time : float
+            Imaging time, setting the number of photons per atom.
+        mode : str, optional
+            Can be 'photons' (sample, diffract and bin every photon) or
+            'expected' (integrate every atom's gaussian image over the pixels
+            and draw one Poisson number per pixel, at a cost independent of
+            the number of photons) or 'stream' (as 'photons', but generating,
+            diffracting and binning photons in chunks). The default is
+            'photons'.
+        max_memory : int, optional
+            Approximate peak memory in bytes taken by the photons of one chunk
+            in 'stream' mode. The default is 256 MiB.
+
+        Notes
+        -----
+        The modes share their mean image but not their noise. Every atom
+        emits a fixed number of photons n, so the photons binned into an
+        aperture holding a fraction F of its image are binomial, and the
+        camera draws Poisson shot noise around them again. Box counts of the
+        'photons' and 'stream' modes thus carry an extra variance of
+        n*F*(1 - F) photons over the 'expected' mode, whose single Poisson
+        draw per pixel follows statistics.get_count_components.
+        """
+        if mode == 'photons':
+            # generate fluorescence photons
+            photon_positions = self.atoms.generate_photons(self.imaging.collection_rate,
+                                                           self.geometry.sigma_thermal,
+                                                           imaging_time,
+                                                           self.imaging.optics.collection_efficiency)
+            
+            # propagate them through the imaging optics
+            photon_positions = self.imaging.optics.apply_diffraction(photon_positions)
+            
+            # collect them on the camera
+            self.imaging.camera.expose(photon_positions)
+            
+        elif mode == 'stream':
+            camera = self.imaging.camera
+            incident_photons = np.zeros(camera.image_shape)
+            chunk_size = max(1, int(max_memory // photon_bytes))
+            
+            for photon_positions in self.atoms.generate_photon_chunks(self.imaging.collection_rate,
+                                                                      self.geometry.sigma_thermal,
+                                                                      imaging_time,
+                                                                      self.imaging.optics.collection_efficiency,
+                                                                      chunk_size=chunk_size):
+                photon_positions = self.imaging.optics.apply_diffraction(photon_positions)
+                camera.bin_photons(photon_positions, out=incident_photons)
+            
+            camera.read_out(incident_photons)
+            
+        elif mode == 'expected':
+            self.atoms.n_photons = self.get_n_photons(imaging_time)
+            sigma = self.atoms.get_atom_sigma(self.get_spot_sigma())
+            
+            expected_photons = self.imaging.camera.get_expected_photons(self.atoms.atom_positions,
+                                                                        self.atoms.n_photons, sigma)
+            self.imaging.camera.read_out(expected_photons)
+            
+        else:
+            raise Exception(f'Invalid imaging mode {mode}')
+        
+    def generate_shots(self, n_shots, imaging_time, mode='expected', filename=None, chunk_size=64,
+                       max_memory=2**28, first_shot=None):
+        """
+        Loads and images n_shots independent realizations of the array at
+        once, vectorized over shots.
+        
+        Every block of chunk_size shots draws from its own stream of
+        get_shot_rng, so with the same seed and chunk_size a run split into
+        shards, each starting at a multiple of chunk_size, reproduces the
+        undivided run bit for bit. Without first_shot, every call continues
+        after the shots generated before, so repeated calls give new shots.
+
+        Parameters
+        ----------
+        n_shots : int
+            Number of shots.
+        imaging_time : float
+            Imaging time, as for image_atoms.
+        mode : str, optional
+            Can be 'expected' or 'photons', see image_atoms. Photons are
+            generated in chunks as in the 'stream' mode. The default is
+            'expected'.
+        filename : str, optional
+            Write the frames to a memory-mapped .npy file instead of memory.
+        chunk_size : int, optional
+            Number of shots rendered and read out at once. The default is 64.
+        max_memory : int, optional
+            Approximate peak memory in bytes taken by one chunk of photons in
+            'photons' mode, or by the per-site weights of the shots rendered
+            at once in 'expected' mode. The default is 256 MiB.
+        first_shot : int, optional
+            Index of the first shot within a longer run, a multiple of
+            chunk_size. The default is the number of shots generated since
+            the experiment was seeded, rounded up to a multiple of
+            chunk_size.
+
+        Returns
+        -------
+        frames : ndarray
+            Camera images of shape (n_shots, H, W) and dtype uint16.
+        masks : ndarray
+            Ground truth occupation of shape (n_shots, ni, nj).
+
+        """
+        if mode not in ['expected', 'photons']:
+            raise Exception(f'Invalid imaging mode {mode}')
+        if first_shot is None:
+            first_shot = -(-self.shots_generated // chunk_size) * chunk_size
+        if first_shot % chunk_size:
+            raise Exception('first_shot must be a multiple of chunk_size.')
+        
+        camera = self.imaging.camera
+        shape = (n_shots,) + tuple(camera.image_shape)
+        if filename is None:
+            frames = np.empty(shape, dtype='uint16')
+        else:
+            frames = np.lib.format.open_memmap(filename, mode='w+', dtype='uint16', shape=shape)
+        masks = np.zeros((n_shots,) + tuple(self.geometry.n_sites), dtype=bool)
+        
+        if mode == 'expected':
+            # atoms sit at the sites, so every shot is a weighted sum of site images
+            n_photons = self.get_n_photons(imaging_time)
+            fraction_x, fraction_y = camera.get_spot_fractions(self.geometry.positions, self.get_spot_sigma())
+            shot_block = max(1, int(max_memory // fraction_x.nbytes))
+        else:
+            photon_chunk = max(1, int(max_memory // photon_bytes))
+        
+        # the camera keeps its last single frame
+        rng, image, signal = self.rng, camera.image, camera.signal
+        try:
+            for start in range(0, n_shots, chunk_size):
+                stop = min(start + chunk_size, n_shots)
+                self.set_rng(self.get_shot_rng(first_shot + start))
+                
+                self.atoms.load_atoms(self.geometry.positions, self.geometry.filling_distribution,
+                                      self.geometry.filling_distribution_kwargs,
+                                      avg_filling=self.geometry.avg_filling, n_shots=stop - start)
+                occupancies = self.atoms.occupancies
+                masks[start:stop, self.geometry.indices[0], self.geometry.indices[1]] = occupancies > 0
+                
+                if mode == 'expected':
+                    # weights of shape (shots, H, n_sites), a few shots at a time
+                    incident_photons = np.empty((stop - start,) + tuple(camera.image_shape))
+                    for block in range(0, stop - start, shot_block):
+                        weights = n_photons * occupancies[block:block + shot_block, np.newaxis, :] * fraction_x.T
+                        incident_photons[block:block + shot_block] = weights @ fraction_y
+                else:
+                    incident_photons = np.zeros((stop - start,) + tuple(camera.image_shape))
+                    for photon_positions, shots in self.atoms.generate_photon_chunks(self.imaging.collection_rate,
+                                                                                     self.geometry.sigma_thermal,
+                                                                                     imaging_time,
+                                                                                     self.imaging.optics.collection_efficiency,
+                                                                                     chunk_size=photon_chunk,
+                                                                                     return_shots=True):
+                        photon_positions = self.imaging.optics.apply_diffraction(photon_positions)
+                        camera.bin_photons(photon_positions, out=incident_photons, shots=shots)
+                
+                camera.read_out(incident_photons)
+                frames[start:stop] = camera.image
+        finally:
+            self.set_rng(rng)
+            camera.image, camera.signal = image, signal
+        self.shots_generated = max(self.shots_generated, first_shot + n_shots)
+        
+        return frames, masks
+        
+    def get_n_photons(self, imaging_time):
+        """
+        Returns the number of photons per atom reaching the camera, as
+        generated by image_atoms.
+        """
+        return int(imaging_time * self.imaging.collection_rate * self.imaging.optics.collection_efficiency)
+    
+    def get_spot_sigma(self):
+        """
+        Returns the (x, y) width in m of an atom's image, combining thermal
+        motion in the tweezer with the diffraction limit of the optics, of
+        shape (2,), or (2, n_sites) for a per-site thermal width.
+        """
+        sigma_thermal = np.asarray(self.geometry.sigma_thermal, dtype=float)
+        if sigma_thermal.ndim < 2:
+            sigma_thermal = np.broadcast_to(sigma_thermal, (2,))
+        
+        return np.sqrt(sigma_thermal**2 + self.imaging.optics.sigma_diffraction**2)
+    
+    def get_psf_sigma(self):
+        """
+        Returns the width of get_spot_sigma in px.
+        """
+        sigma = self.get_spot_sigma()
+        
+        return sigma / np.reshape(self.imaging.camera.scale, (2,) + (1,)*(sigma.ndim - 1))
+    
+    def predict_fidelity(self, imaging_time, half_width=2, p_filled=None, background=None,
+                         decimals=4, **prediction_kwargs):
+        """
+        Predicts the fidelity of classifying every site by thresholding its
+        counts in a (2*half_width + 1) px box, as DetectionBot.set_site_boxes
+        places them, from the camera noise model instead of simulated shots.
+
+        Parameters
+        ----------
+        imaging_time : float
+            Imaging time, as for image_atoms.
+        half_width : int, optional
+            Half width of the box around every site in px. The default is 2.
+        p_filled : float, optional
+            Probability of a site being occupied. The default is the mean
+            filling of the tweezers.
+        background : float, optional
+            Per-pixel baseline subtracted from the thresholds. The default is
+            the camera signal offset.
+        decimals : int, optional
+            Decimals of the PSF fraction used to group sites. The default is
+            4.
+        **prediction_kwargs
+            Passed to statistics.predict_fidelity, e.g. a threshold, or
+            method='importance' for importance-sampled error rates.
+
+        Returns
+        -------
+        prediction : dict
+            Arrays of shape n_sites for 'threshold', 'false_positive',
+            'false_negative', 'fidelity' and the confidence interval of the
+            'importance' method, see statistics.predict_fidelity.
+
+        """
+        camera = self.imaging.camera
+        if p_filled is None:
+            p_filled = np.mean(self.geometry.avg_filling)
+        if background is None:
+            background = camera.signal_offset
+        
+        # site centers in image px, where pixel k spans k - 0.5 to k + 0.5
+        centers = self.geometry.positions.T / camera.scale + np.subtract(camera.position, camera.origin) - 0.5
+        anchors = np.round(centers).astype('int')
+        
+        x0 = np.clip(anchors[:, 0] - half_width, 0, camera.image_shape[0])
+        x1 = np.clip(anchors[:, 0] + half_width + 1, 0, camera.image_shape[0])
+        y0 = np.clip(anchors[:, 1] - half_width, 0, camera.image_shape[1])
+        y1 = np.clip(anchors[:, 1] + half_width + 1, 0, camera.image_shape[1])
+        
+        fractions = get_psf_fraction(centers, (x0, x1, y0, y1), self.get_psf_sigma())
+        if prediction_kwargs.get('threshold') is not None:
+            threshold = np.broadcast_to(prediction_kwargs['threshold'], self.geometry.n_sites)
+            prediction_kwargs['threshold'] = threshold[tuple(self.geometry.indices)]
+        prediction = predict_fidelity(camera, self.get_n_photons(imaging_time), np.round(fractions, decimals),
+                                      (x1 - x0)*(y1 - y0), p_filled=p_filled, background=background,
+                                      rng=self.rng, **prediction_kwargs)
         
-        # propagate them through the imaging optics
-        photon_positions = self.imaging.optics.apply_diffraction(photon_positions)
+        # sites are listed in the order of geometry.indices
+        for key, value in prediction.items():
+            prediction[key] = np.zeros(self.geometry.n_sites)
+            prediction[key][tuple(self.geometry.indices)] = value
         
-        # collect them on the camera
-        self.imaging.camera.expose(photon_positions)
+        return prediction
         
     def show_atoms(self, image=None, roi=None, title=None, colorbar=False, scalebar=True, scalebar_length=None):
         if scalebar_length is None:
@@ -20,12 +20,46 @@ class Tweezer:
 class Tweezers:
     def __init__(self, n_sites, spacing, angle, offset, wavelength, power, waist,
                  avg_filling, filling_distribution='binomial',
-                 filling_distribution_kwargs={}):
+                 filling_distribution_kwargs={}, layout='rectangular', target=None):
+        """
+        Parameters
+        ----------
+        n_sites : tuple
+            Number of sites (ni, nj) along the two lattice directions.
+        spacing : tuple
+            Site spacing in m along the two lattice directions.
+        angle : float
+            Angle in rad between the j direction and the y axis of
+            rectangular layouts.
+        offset : tuple
+            Position in m of site (0, 0).
+        wavelength, waist : float
+            Tweezer laser settings, see Laser.
+        power : float or ndarray
+            Tweezer power in W, or an array of shape n_sites, or with one
+            entry per site, for nonuniform arrays.
+        avg_filling : float or ndarray
+            Mean occupancy of every site, or an array of shape n_sites.
+        filling_distribution : str, optional
+            See Atoms.load_atoms. The default is 'binomial'.
+        filling_distribution_kwargs : dict, optional
+            See Atoms.load_atoms.
+        layout : str, optional
+            Can be 'rectangular' (sheared by angle), 'triangular' (every
+            other j row shifted by half a spacing) or 'hex' (honeycomb, every
+            site with three neighbours at one spacing). The default is
+            'rectangular'.
+        target : ndarray, optional
+            Boolean array of shape n_sites, keeping only the sites where it
+            is True, e.g. a sparse target pattern. The default keeps all.
+        """
         
         self.n_sites = n_sites
         self.spacing = spacing
         self.angle = angle
         self.offset=offset
+        self.layout = layout
+        self.target = target
         
         self.avg_filling = avg_filling
         self.filling_distribution = filling_distribution
@@ -36,20 +70,33 @@ class Tweezers:
         self.positions = None
         
         # laser for each tweezer
-        self.laser = Laser(wavelength, power, waist)
+        self.set_laser(wavelength, power, waist)
         self.trap_depth = None
         self.sigma_thermal = None
         
         self.generate_sites()
         
-    def set_trap_depth(self, trap_depth=None, atoms=None, verbose=False):
+    def set_laser(self, wavelength, power, waist):
+        self.laser = Laser(wavelength, power, waist)
+        
+        if self.indices is not None:
+            self.power = self.get_site_values(self.laser.power)
         
+    def set_trap_depth(self, trap_depth=None, atoms=None, verbose=False):
+        """
+        Set the trap depth in K, computed from the atom species unless given.
+        With a per-site power, the depth is an array with one entry per site,
+        unless all sites have the same power.
+        """
         if trap_depth is not None:
             self.trap_depth = trap_depth
         elif atoms is not None:
+            power = self.laser.power
+            if np.ndim(power):
+                power = self.power[0] if np.all(self.power == self.power[0]) else self.power
             self.trap_depth = trapDepth(species=atoms.species,
                                         intensity = None,
-                                        power = self.laser.power,
+                                        power = power,
                                         waist = self.laser.waist,
                                         wavelength = self.laser.wavelength,
                                         unit='K')
@@ -60,6 +107,11 @@ class Tweezers:
             print('trap depth:', self.trap_depth, 'K')
             
     def set_sigma_thermal(self, sigma_thermal=None, atoms=None, verbose=False):
+        """
+        Set the (x, y) thermal width in m of the atoms, computed from their
+        temperature and the trap depth unless given. A per-site trap depth
+        gives an array of shape (2, n) with one column per site.
+        """
         if sigma_thermal is not None:
             self.sigma_thermal = sigma_thermal
 
@@ -67,9 +119,12 @@ class Tweezers:
             waist = self.laser.waist
             temperature = atoms.temperature
             trap_depth = self.trap_depth
-            sigma_thermal = [w*np.sqrt(-0.5*np.log(1 - temperature/(2*trap_depth))) for w in waist]
+            width = np.sqrt(-0.5*np.log(1 - temperature/(2*trap_depth)))
             
-            self.sigma_thermal = tuple(sigma_thermal)
+            if np.ndim(width) == 0:
+                self.sigma_thermal = tuple(w*width for w in waist)
+            else:
+                self.sigma_thermal = np.multiply.outer(waist, width)
             
         else:
             raise Exception('Must provide atom properties or fix sigma_thermal')
@@ -79,50 +134,108 @@ class Tweezers:
     
     def get_position(self, i, j):
         """
-        Calculates position of site (i,j).
+        Calculates position of site (i,j), relative to the offset.
         """
         if np.shape(i) != np.shape(j):
             raise Exception('i and j must be the same shape')
         
-        x = i*self.spacing[0] + j*self.spacing[1]*np.sin(self.angle)
-        y = j*self.spacing[1]*np.cos(self.angle)
+        if self.layout == 'rectangular':
+            x = i*self.spacing[0] + j*self.spacing[1]*np.sin(self.angle)
+            y = j*self.spacing[1]*np.cos(self.angle)
+            
+        elif self.layout == 'triangular':
+            x = (i + 0.5*(j % 2))*self.spacing[0]
+            y = j*self.spacing[1]*np.sqrt(3)/2
+            
+        elif self.layout == 'hex':
+            # sites alternate up and down along i, and pair up along j
+            x = i*self.spacing[0]*np.sqrt(3)/2
+            y = (1.5*j + 0.5*((i + j) % 2))*self.spacing[1]
+            
+        else:
+            raise Exception(f'Invalid layout {self.layout}')
         
         return x, y
     
     def generate_sites(self): 
         """
-        Generate and store lists of indices and physical positions of each tweezer.
+        Generate and store arrays of indices, physical positions, mean
+        filling and power of each tweezer, of shape (2, n) or (n,).
         """
         ni, nj = self.n_sites
-        ivec = np.arange(ni)
-        jvec = np.arange(nj)
-        iarr, jarr = np.meshgrid(ivec, jvec)
-        xarr, yarr = self.get_position(iarr,jarr)
+        iarr, jarr = np.meshgrid(np.arange(ni), np.arange(nj))
+        iarr, jarr = iarr.ravel(), jarr.ravel()
+        
+        if self.target is not None:
+            target = np.asarray(self.target, dtype=bool)
+            if target.shape != (ni, nj):
+                raise Exception(f'Target of shape {target.shape} does not match {self.n_sites} sites')
+            keep = target[iarr, jarr]
+            iarr, jarr = iarr[keep], jarr[keep]
         
-        xarr += self.offset[0]
-        yarr += self.offset[1]
+        xarr, yarr = self.get_position(iarr, jarr)
         
-        self.indices = np.stack([iarr.flatten(), jarr.flatten()])
-        self.positions = np.stack([xarr.flatten(), yarr.flatten()])
+        self.indices = np.stack([iarr, jarr])
+        self.positions = np.stack([xarr + self.offset[0], yarr + self.offset[1]])
         
-        try:
-            len(self.avg_filling)
-            self.avg_filling = self.avg_filling.flatten()
-        except:
-            self.avg_filling = [self.avg_filling]*(ni*nj)
+        # flat index of every site (i, j), -1 where there is none
+        self.flat_indices = np.full((ni, nj), -1)
+        self.flat_indices[iarr, jarr] = np.arange(len(iarr))
         
+        self.avg_filling = self.get_site_values(self.avg_filling)
+        self.power = self.get_site_values(self.laser.power)
         
-        self.sites = [Tweezer(*args) for args in zip(self.positions.T, self.indices.T, self.avg_filling)]
+        self._sites = None
+        
+    def get_site_values(self, values):
+        """
+        Returns a value per site, from a scalar, an array of shape n_sites or
+        an array with one entry per site.
+        """
+        values = np.asarray(values, dtype=float)
+        n = self.indices.shape[1]
+        
+        if values.shape == tuple(self.n_sites):
+            return values[self.indices[0], self.indices[1]]
+        if values.shape == (n,):
+            return values
+        if values.ndim:
+            raise Exception(f'Per-site values of shape {values.shape} do not match the {n} sites '
+                            f'of n_sites {tuple(self.n_sites)}')
+        
+        return np.full(n, values)
+    
+    def get_flat_index(self, i, j):
+        """
+        Returns the flat index of sites (i, j), i.e. their position along the
+        site arrays, or -1 for sites left out by the target.
+        """
+        return self.flat_indices[i, j]
+    
+    def get_site_indices(self, flat_index):
+        """
+        Returns the (i, j) indices of sites given by their flat index.
+        """
+        i, j = self.indices[:, flat_index]
+        
+        return i, j
+    
+    @property
+    def sites(self):
+        """
+        List of Tweezer objects, built on first use.
+        """
+        if self._sites is None:
+            self._sites = [Tweezer(*args) for args in zip(self.positions.T, self.indices.T, self.avg_filling)]
+        
+        return self._sites
         
     def set_gt_mask(self):
         if self.occupancies is None:
             raise Exception('Must set occupancies before generating ground truth mask')
             
         mask = np.zeros(self.n_sites, dtype=bool)
-            
-        for idx, idx_tuple in enumerate(self.indices.T):
-            i, j = idx_tuple
-            mask[i,j] = bool(self.occupancies[idx])
+        mask[self.indices[0], self.indices[1]] = np.asarray(self.occupancies) > 0
             
         self.gt_mask = mask
         
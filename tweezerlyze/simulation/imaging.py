@@ -5,6 +5,7 @@ Created on Sun May 24 15:15:51 2020
 @author: Jacob
 """
 import numpy as np
+from scipy.special import ndtr
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
@@ -128,12 +129,21 @@ noise_factor = np.sqrt(2)
 # We observe a constant offset of ~500 counts, reagardless of camera settings
 signal_offset = 500
 
+# Time to shift one row down the image area, at the fastest vertical shift
+# speed recommended for the iXon Ultra 888.
+# unit: s/row
+vertical_shift_time = 0.6e-6
+
 #standard values: preamp gain 1, 30 MHz hss, EM amplifier type, EM gain 100
 
 
 class Optics():
-    def __init__(self, magnification, NA):
+    def __init__(self, magnification, NA, rng=None):
         self.magnification = magnification
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.set_NA(NA)
+        
+    def set_NA(self, NA):
         self.NA = NA
         self.collection_efficiency = 0.5*(1 - np.sqrt(1 - NA**2))
         
@@ -145,79 +155,212 @@ class Optics():
         # "It seems like quite a lot of effort to simulate images with PSFs that
         # correspond to diffraction effects, only to end up with images that look 
         # like those generated with Gaussian PSFs."
-        return np.random.normal(loc=photon_positions, scale=self.sigma_diffraction)
+        return self.rng.normal(loc=photon_positions, scale=self.sigma_diffraction)
         
 
 class IxonUltra888():
     def __init__(self, pixel_size, sensor_size, gain, preamp_setting, 
                  amplifier_type, readout_rate, sensor_temperature, 
-                 exposure_time, position=(0,0)):
+                 exposure_time, position=(0,0), roi=None, crop_mode=False, rng=None):
         
         # store settings
         self.pixel_size = pixel_size
         self.sensor_size = sensor_size
         self.gain = gain
-        self.preamp_setting = preamp_setting
-        self.amplifier_type = amplifier_type
-        self.readout_rate = readout_rate
-        self.sensor_temperature = sensor_temperature
-        self.exposure_time = exposure_time
         self.position = position
         
         # containers and state booleans
         self.photon_positions = None
         self.image = None
+        self.signal = None
         self.scale_set = False
+        self.rng = np.random.default_rng() if rng is None else rng
         
         # store performance sheet specs
-        self.sensitivity = sensitivity_dict[preamp_setting][amplifier_type][readout_rate]
-        self.single_pixel_noise = single_pixel_noise_dict[preamp_setting][amplifier_type][readout_rate]
         self.well_depth = well_depth
         self.clock_induced_charge_occurence = clock_induced_charge_occurence
         self.minimum_dark_current = minimum_dark_current
         self.quantum_efficiency = quantum_efficiency
         self.signal_offset = signal_offset
+        self.vertical_shift_time = vertical_shift_time
+        
+        self.set_readout(preamp_setting, amplifier_type, readout_rate)
+        self.set_dark_charge(sensor_temperature, exposure_time)
+        self.set_roi(roi, crop_mode)
+        
+    def set_readout(self, preamp_setting, amplifier_type, readout_rate):
+        """
+        Set the readout settings and look up their sensitivity and readout
+        noise on the performance sheet.
+        """
+        self.preamp_setting = preamp_setting
+        self.amplifier_type = amplifier_type
+        self.readout_rate = readout_rate
+        
+        self.sensitivity = sensitivity_dict[preamp_setting][amplifier_type][readout_rate]
+        self.single_pixel_noise = single_pixel_noise_dict[preamp_setting][amplifier_type][readout_rate]
+        
+    def set_dark_charge(self, sensor_temperature, exposure_time):
+        """
+        Set the sensor temperature and exposure time, which give the dark
+        charge per pixel.
+        """
+        self.sensor_temperature = sensor_temperature
+        self.exposure_time = exposure_time
+        
         self.dark_current = getDarkCurrent(sensor_temperature, unit='K')
         self.dark_charge = self.dark_current * self.exposure_time
-        # self.
+        
+    def set_roi(self, roi=None, crop_mode=False):
+        """
+        Restrict the readout to a sub-array of the sensor, so that only its
+        pixels are simulated and returned as the image.
+
+        Parameters
+        ----------
+        roi : dict, optional
+            Sensor pixels 'xmin' to 'xmax' and 'ymin' to 'ymax' to read out,
+            as for crop_image. The default is the full sensor.
+        crop_mode : bool, optional
+            Whether the sensor is operated in crop mode, where only the rows
+            of the sub-array are shifted out, shortening the readout time.
+            The default is False.
+        """
+        if roi is None:
+            roi = {'xmin': 0, 'xmax': self.sensor_size[0], 'ymin': 0, 'ymax': self.sensor_size[1]}
+        
+        if not (0 <= roi['xmin'] < roi['xmax'] <= self.sensor_size[0]
+                and 0 <= roi['ymin'] < roi['ymax'] <= self.sensor_size[1]):
+            raise Exception(f'ROI {roi} does not fit on the {self.sensor_size} sensor.')
+        
+        self.roi = dict(roi)
+        self.crop_mode = crop_mode
+        self.origin = (roi['xmin'], roi['ymin'])
+        self.image_shape = (roi['xmax'] - roi['xmin'], roi['ymax'] - roi['ymin'])
+        
+        if self.scale_set:
+            self.set_pixel_bins()
+        
+    def get_readout_time(self):
+        """
+        Returns the time in s to read out one image: every row (first image
+        axis) is shifted vertically, or only those of the sub-array in crop
+        mode, and every pixel of the sub-array is digitized.
+        """
+        n_rows = self.image_shape[0] if self.crop_mode else self.sensor_size[0]
+        
+        return n_rows*self.vertical_shift_time + self.image_shape[0]*self.image_shape[1]/self.readout_rate
         
     def set_scale(self, magnification):
         # scale of image in um/px
         self.scale = np.array(self.pixel_size)/magnification
-        
-        # set pixel bins according to scale
-        pixel_bins_x = (np.arange(self.sensor_size[0]+1) - self.position[0])*self.scale[0]
-        pixel_bins_y = (np.arange(self.sensor_size[1]+1) - self.position[1])*self.scale[1]
-        self.pixel_bins = [pixel_bins_x, pixel_bins_y]
+        self.set_pixel_bins()
         
         self.scale_set = True
+        
+    def set_pixel_bins(self):
+        # set bins of the pixels read out according to scale
+        pixel_bins_x = (self.origin[0] + np.arange(self.image_shape[0]+1) - self.position[0])*self.scale[0]
+        pixel_bins_y = (self.origin[1] + np.arange(self.image_shape[1]+1) - self.position[1])*self.scale[1]
+        self.pixel_bins = [pixel_bins_x, pixel_bins_y]
     
     def expose(self, photon_positions):
+        self.read_out(self.bin_photons(photon_positions))
+        
+    def bin_photons(self, photon_positions, out=None, shots=None):
+        """
+        Returns the number of photons incident on every pixel, adding them to
+        out if given so that photons can be binned chunk by chunk. With the
+        shot index of every photon, photons are binned into a stack of frames
+        out of shape (n_shots, H, W).
+        """
         if not self.scale_set:
             raise Exception('Must set scale before exposing camera.')
         
-        # bin the photons into pixels
-        x = photon_positions[0,:]
-        y = photon_positions[1,:]
-        incident_photons = np.histogram2d(x, y, bins=self.pixel_bins)[0]
+        if out is None:
+            out = np.zeros(self.image_shape if shots is None else (np.max(shots) + 1,) + self.image_shape)
+        
+        # bin the photons into pixels, dropping those that miss the sub-array
+        i = np.floor(photon_positions[0,:]/self.scale[0] + self.position[0] - self.origin[0]).astype('int')
+        j = np.floor(photon_positions[1,:]/self.scale[1] + self.position[1] - self.origin[1]).astype('int')
+        hits = (i >= 0) & (i < self.image_shape[0]) & (j >= 0) & (j < self.image_shape[1])
+        
+        pixels = i[hits]*self.image_shape[1] + j[hits]
+        if shots is not None:
+            pixels += shots[hits]*self.image_shape[0]*self.image_shape[1]
+        out += np.bincount(pixels, minlength=out.size).reshape(out.shape)
+        
+        return out
+    
+    def get_spot_fractions(self, atom_positions, sigma):
+        """
+        Returns the fractions of gaussian spots of width sigma, centered at
+        atom_positions (2, n_atoms), that fall on every pixel row and column,
+        as arrays of shape (n_atoms, H) and (n_atoms, W). The width is a
+        scalar, an (x, y) pair or an array of shape (2, n_atoms).
+        """
+        if not self.scale_set:
+            raise Exception('Must set scale before exposing camera.')
         
+        sigma = np.asarray(sigma, dtype=float)
+        if sigma.ndim < 2:
+            sigma = np.broadcast_to(sigma, (2,))[:, np.newaxis]
+        sigma_x, sigma_y = sigma[:, :, np.newaxis]
+        
+        # fraction of every spot falling between the pixel edges, per axis
+        fraction_x = np.diff(ndtr((self.pixel_bins[0] - atom_positions[0, :, np.newaxis])/sigma_x), axis=1)
+        fraction_y = np.diff(ndtr((self.pixel_bins[1] - atom_positions[1, :, np.newaxis])/sigma_y), axis=1)
+        
+        return fraction_x, fraction_y
+    
+    def get_expected_photons(self, atom_positions, n_photons, sigma):
+        """
+        Returns the mean number of photons incident on every pixel from atoms
+        imaged as gaussian spots, integrating each spot over the pixel area.
+
+        Parameters
+        ----------
+        atom_positions : ndarray
+            Atom positions of shape (2, n_atoms).
+        n_photons : float
+            Mean number of photons reaching the camera from one atom.
+        sigma : float, tuple or ndarray
+            (x, y) width of the spots, in the units of the positions, or an
+            array of shape (2, n_atoms) with the width of every spot.
+
+        Returns
+        -------
+        expected_photons : ndarray
+            Mean photon numbers of the image shape.
+
+        """
+        fraction_x, fraction_y = self.get_spot_fractions(atom_positions, sigma)
+        
+        return n_photons * fraction_x.T @ fraction_y
+    
+    def read_out(self, incident_photons):
+        """
+        Converts photons incident on every pixel, either binned photons or
+        expected photon numbers, into a camera image. Shot noise is drawn
+        around them, followed by the sensor and readout noise.
+        """
         # to account for shot noise we resample our binned photons from a poisson distribution
         # TODO: should noise factor be here?
-        incident_photons = np.random.poisson(incident_photons)
+        incident_photons = self.rng.poisson(incident_photons)
         
         # photoelectrons is incident photons multiplied by quantum efficiency
         photoelectrons = incident_photons * self.quantum_efficiency      
         
         # add pre-gain photoelectron noise sources
-        dark_noise = np.random.poisson(self.dark_charge, photoelectrons.shape)
-        charge_noise = np.random.poisson(self.clock_induced_charge_occurence, photoelectrons.shape)
+        dark_noise = self.rng.poisson(self.dark_charge, photoelectrons.shape)
+        charge_noise = self.rng.poisson(self.clock_induced_charge_occurence, photoelectrons.shape)
         photoelectrons += (dark_noise + charge_noise) * noise_factor
         
         # signal electrons are photoelectrons multipled by EM gain
         signal_electrons = photoelectrons * self.gain
         
         # combine signal with electron readout noise to get image electrons
-        readout_noise = np.random.normal(0, self.single_pixel_noise, self.sensor_size)
+        readout_noise = self.rng.normal(0, self.single_pixel_noise, photoelectrons.shape)
         image_electrons = signal_electrons + readout_noise
         
         # convert electrons to digital camera signal
@@ -251,10 +394,17 @@ class IxonUltra888():
     
     def crop_image(self, roi):
         """
-        Crops the most recently acquired image.
+        Crops the most recently acquired image. The roi is given in sensor
+        pixels and must lie within the sub-array read out.
         """
-        self.image_cropped = self.image[roi['xmin']:roi['xmax'], roi['ymin']:roi['ymax']]
-        self.signal_cropped = self.signal[roi['xmin']:roi['xmax'], roi['ymin']:roi['ymax']]
+        xmin, xmax = roi['xmin'] - self.origin[0], roi['xmax'] - self.origin[0]
+        ymin, ymax = roi['ymin'] - self.origin[1], roi['ymax'] - self.origin[1]
+        
+        if not (0 <= xmin < xmax <= self.image_shape[0] and 0 <= ymin < ymax <= self.image_shape[1]):
+            raise Exception(f'ROI {roi} lies outside the sub-array read out {self.roi}.')
+        
+        self.image_cropped = self.image[xmin:xmax, ymin:ymax]
+        self.signal_cropped = self.signal[xmin:xmax, ymin:ymax]
 
             
         return self.image_cropped
@@ -303,13 +453,13 @@ class IxonUltra888():
         
         
 class Imaging():
-    def __init__(self, optics_options, camera_options, laser_options, scattering_rate=None, **kwargs):
+    def __init__(self, optics_options, camera_options, laser_options, scattering_rate=None, rng=None, **kwargs):
         self.laser = Laser(**laser_options)
         
-        self.optics = Optics(**optics_options)
+        self.optics = Optics(**optics_options, rng=rng)
         self.optics.set_diffraction(self.laser.wavelength)
         
-        self.camera = IxonUltra888(**camera_options)
+        self.camera = IxonUltra888(**camera_options, rng=rng)
         self.camera.set_scale(self.optics.magnification)
         
         self.set_rates(scattering_rate)
@@ -15,22 +15,20 @@ class Laser():
         ----------
         wavelength : float
             wavelength in m.
-        power : float
-            power in W.
+        power : float or array
+            power in W, an array for one value per tweezer.
         waist : float or iterable of len 2
             beam waist in m.
         """
         
         self.wavelength = wavelength
+        if np.ndim(power):
+            power = np.asarray(power, dtype=float)
         self.power = power
         
-        print(waist)
-        
         # waist should be a length 2 iterable
         try:
-            print('hi')
             iter(waist)
-            print(len(waist)==2)
             assert(len(waist)==2)
         except TypeError:
             waist = (waist, waist)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Searches over imaging settings driven by simulated shots.
+"""
+
+import numpy as np
+from scipy.stats import beta
+
+
+def simulate_shots(experiment, imaging_time, n_shots, roi=None, mode='photons', first_shot=None, chunk_size=64):
+    """
+    Returns n_shots freshly loaded and imaged frames with their ground truth
+    masks, as arrays of shape (n_shots, H, W) and (n_shots, ni, nj), using
+    Experiment.generate_shots. The roi is given in sensor pixels, as for
+    IxonUltra888.crop_image. The default mode simulates every photon, the
+    faster 'expected' mode has less shot noise, see Experiment.image_atoms.
+    Unless first_shot is given, the shots follow those generated before.
+    """
+    frames, masks = experiment.generate_shots(n_shots, imaging_time, mode=mode, chunk_size=chunk_size,
+                                              first_shot=first_shot)
+
+    if roi is not None:
+        origin = experiment.imaging.camera.origin
+        frames = frames[:, roi['xmin'] - origin[0]:roi['xmax'] - origin[0],
+                        roi['ymin'] - origin[1]:roi['ymax'] - origin[1]]
+
+    return frames, masks
+
+
+def check_fidelity(experiment, detector, imaging_time, target_fidelity, roi=None,
+                   batch_size=20, max_shots=2000, confidence=0.95, indifference=0.2, mode='photons'):
+    """
+    Decides whether detection at imaging_time meets target_fidelity with a
+    sequential probability ratio test, simulating batches of shots only until
+    the decision is settled.
+
+    The test weighs a site error rate (1 - target_fidelity)*(1 - indifference)
+    against (1 - target_fidelity)*(1 + indifference), with error
+    probabilities 1 - confidence for both wrong decisions. If max_shots is
+    reached first, the point estimate decides. Shots are simulated in the
+    given mode of simulate_shots, every batch continuing the shot stream of
+    the experiment so that no shot is counted twice.
+
+    Returns
+    -------
+    passed : bool
+        Whether the fidelity target is met.
+    errors : int
+        Number of misclassified sites.
+    n_sites : int
+        Number of classified sites.
+    n_shots : int
+        Number of simulated shots.
+    """
+    error_rate = 1 - target_fidelity
+    p0 = error_rate*(1 - indifference)
+    p1 = min(error_rate*(1 + indifference), 1 - 1e-12)
+
+    alpha = 1 - confidence
+    upper = np.log((1 - alpha)/alpha)
+    lower = -upper
+
+    errors = 0
+    n_sites = 0
+    n_shots = 0
+    log_ratio = 0
+    # one generate_shots block per batch, after all shots generated so far
+    first_shot = -(-experiment.shots_generated // batch_size) * batch_size
+
+    while n_shots < max_shots:
+        n_batch = min(batch_size, max_shots - n_shots)
+        frames, masks = simulate_shots(experiment, imaging_time, n_batch, roi=roi, mode=mode,
+                                       first_shot=first_shot + n_shots, chunk_size=batch_size)
+        found = detector(frames, imaging_time)
+
+        batch_errors = int(np.count_nonzero(found != masks))
+        batch_sites = masks.size
+        errors += batch_errors
+        n_sites += batch_sites
+        n_shots += n_batch
+
+        log_ratio += batch_errors*np.log(p1/p0) + (batch_sites - batch_errors)*np.log((1 - p1)/(1 - p0))
+        if log_ratio >= upper:
+            return False, errors, n_sites, n_shots
+        if log_ratio <= lower:
+            return True, errors, n_sites, n_shots
+
+    return errors/n_sites <= error_rate, errors, n_sites, n_shots
+
+
+def find_imaging_time(experiment, detector, target_fidelity, time_range, roi=None,
+                      tolerance=0.05, confidence=0.95, **test_kwargs):
+    """
+    Finds the shortest imaging time at which detection meets a fidelity
+    target, by bisection in log time with a sequential test at every step.
+
+    Parameters
+    ----------
+    experiment : Experiment
+        Experiment to simulate shots with.
+    detector : callable
+        Called as detector(frames, imaging_time) on (n_shots, H, W) frames,
+        returning (n_shots, ni, nj) boolean occupancies. The imaging time lets
+        it adapt thresholds or likelihood tables, e.g.
+
+            def detector(frames, imaging_time):
+                bot.set_likelihood_table(camera, experiment.get_n_photons(imaging_time), sigma)
+                return bot.get_site_masks(frames, 0, method='likelihood')[0]
+
+    target_fidelity : float
+        Required fraction of correctly classified sites.
+    time_range : tuple
+        Shortest and longest imaging time to consider. The longest must meet
+        the target.
+    roi : dict, optional
+        Crop applied to every frame, as for IxonUltra888.crop_image. The
+        default is the full image.
+    tolerance : float, optional
+        Relative width of the final bracket. The default is 0.05.
+    confidence : float, optional
+        Confidence of every sequential decision and of the returned bound.
+        The default is 0.95.
+    **test_kwargs
+        Passed to check_fidelity, e.g. mode='expected' for faster but less
+        noisy shots.
+
+    Returns
+    -------
+    result : dict
+        'imaging_time' (shortest passing time), 'fidelity' and
+        'fidelity_lower' (one-sided Clopper-Pearson bound at confidence) at
+        that time, the total 'n_shots' simulated and the 'history' of tested
+        (imaging_time, passed, fidelity, n_shots) tuples.
+    """
+    history = []
+
+    def test(imaging_time):
+        passed, errors, n_sites, n_shots = check_fidelity(experiment, detector, imaging_time,
+                                                          target_fidelity, roi=roi,
+                                                          confidence=confidence, **test_kwargs)
+        history.append((imaging_time, passed, 1 - errors/n_sites, n_shots))
+        return passed, errors, n_sites
+
+    t_low, t_high = time_range
+
+    passed, errors, n_sites = test(t_high)
+    if not passed:
+        raise Exception(f'Fidelity target not met at the longest imaging time {t_high}.')
+    best = (errors, n_sites)
+
+    passed, errors, n_sites = test(t_low)
+    if passed:
+        t_high = t_low
+        best = (errors, n_sites)
+
+    while t_high/t_low > 1 + tolerance:
+        t_mid = np.sqrt(t_low*t_high)
+        passed, errors, n_sites = test(t_mid)
+        if passed:
+            t_high = t_mid
+            best = (errors, n_sites)
+        else:
+            t_low = t_mid
+
+    errors, n_sites = best
+    return {
+        'imaging_time': t_high,
+        'fidelity': 1 - errors/n_sites,
+        'fidelity_lower': 1 - beta.ppf(confidence, errors + 1, n_sites - errors),
+        'n_shots': sum(h[3] for h in history),
+        'history': history,
+        }
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Noise model of summed EMCCD counts: count distributions, thresholds and
+predicted detection errors.
+"""
+
+import numpy as np
+from scipy.special import logsumexp, ndtr, ndtri
+from scipy.stats import poisson
+from .imaging import noise_factor
+
+
+def get_count_components(camera, n_photons, psf_fraction, n_pixels, tail=1e-12):
+    """
+    Describes the distribution of camera counts summed over an aperture as a
+    mixture of gaussians, following the noise model of IxonUltra888.expose:
+    poissonian photons scaled by the quantum efficiency, poissonian dark and
+    clock induced charge scaled by the noise factor, EM gain, gaussian readout
+    noise, A/D conversion and the signal offset.
+
+    Parameters
+    ----------
+    camera : IxonUltra888
+        Camera providing the sensitivity, readout noise, gain, offset, dark
+        charge and clock induced charge.
+    n_photons : float
+        Mean number of photons reaching the camera from one atom. Use 0 for
+        an empty site.
+    psf_fraction : float or ndarray
+        Fraction of the photons landing inside the aperture.
+    n_pixels : int or ndarray
+        Number of pixels in the aperture.
+    tail : float, optional
+        Poisson probability below which components are dropped. The default
+        is 1e-12.
+
+    Returns
+    -------
+    log_weights : ndarray
+        Log weight of each component, shape (..., n_components).
+    means : ndarray
+        Mean counts of each component, shape (..., n_components).
+    std : ndarray
+        Common width of the components, shape (...).
+
+    """
+    psf_fraction, n_pixels = np.broadcast_arrays(np.asarray(psf_fraction, dtype=float),
+                                                 np.asarray(n_pixels, dtype=float))
+    photons = n_photons * psf_fraction[..., np.newaxis]
+    dark = (camera.dark_charge + camera.clock_induced_charge_occurence) * n_pixels[..., np.newaxis]
+
+    # photon and dark electron numbers spanning all but the tails
+    k = np.arange(max(0, int(poisson.ppf(tail, np.min(photons)))), int(poisson.isf(tail, np.max(photons))) + 1)
+    d = np.arange(0, max(0, int(poisson.isf(tail, np.max(dark)))) + 1)
+
+    log_weights = poisson.logpmf(k, photons)[..., :, np.newaxis] + poisson.logpmf(d, dark)[..., np.newaxis, :]
+    electrons = (camera.quantum_efficiency*k[:, np.newaxis] + noise_factor*d) * camera.gain
+
+    # conversion to uint16 floors every pixel, shifting it by half a count
+    baseline = n_pixels[..., np.newaxis, np.newaxis]*(camera.signal_offset - 0.5)
+    means = baseline + electrons/camera.sensitivity
+    std = np.sqrt(n_pixels*((camera.single_pixel_noise/camera.sensitivity)**2 + 1/12))
+
+    shape = log_weights.shape[:-2] + (-1,)
+    return log_weights.reshape(shape), np.broadcast_to(means, log_weights.shape).reshape(shape), std
+
+
+def get_log_density(counts, log_weights, means, std):
+    """
+    Returns the log probability density of summed counts for the mixtures
+    of get_count_components, evaluated at counts of shape (..., n_counts).
+    """
+    std = np.asarray(std)[..., np.newaxis, np.newaxis]
+    z = (np.asarray(counts)[..., np.newaxis, :] - means[..., :, np.newaxis]) / std
+
+    return logsumexp(log_weights[..., :, np.newaxis] - 0.5*z**2, axis=-2) - np.log(np.sqrt(2*np.pi)*std[..., 0, :])
+
+
+def get_exceedance(threshold, log_weights, means, std):
+    """
+    Returns the probability that summed counts lie above threshold for the
+    mixtures of get_count_components.
+    """
+    z = (np.asarray(threshold)[..., np.newaxis] - means) / np.asarray(std)[..., np.newaxis]
+
+    return np.sum(np.exp(log_weights) * ndtr(-z), axis=-1)
+
+
+def get_psf_fraction(centers, corners, sigma):
+    """
+    Returns the fraction of a gaussian spot of width sigma (px) centered at
+    centers (n, 2) that falls inside boxes of pixels [x0, x1) x [y0, y1),
+    with corners given as (x0, x1, y0, y1). Pixel k spans k - 0.5 to k + 0.5.
+    The width is a scalar, an (x, y) pair or an array of shape (2, n).
+    """
+    sigma = np.asarray(sigma, dtype=float)
+    if sigma.ndim < 2:
+        sigma = np.broadcast_to(sigma, (2,))
+    x0, x1, y0, y1 = corners
+
+    fraction_x = ndtr((x1 - 0.5 - centers[:, 0])/sigma[0]) - ndtr((x0 - 0.5 - centers[:, 0])/sigma[0])
+    fraction_y = ndtr((y1 - 0.5 - centers[:, 1])/sigma[1]) - ndtr((y0 - 0.5 - centers[:, 1])/sigma[1])
+
+    return fraction_x * fraction_y
+
+
+def get_optimal_threshold(empty, occupied, p_filled=0.5, n_points=32, tolerance=1e-3):
+    """
+    Finds the threshold on summed counts minimizing the classification error
+    between the empty and occupied mixtures of get_count_components, i.e.
+    where the densities weighted by 1 - p_filled and p_filled cross.
+
+    The crossing is bracketed on a grid of n_points between the mean empty
+    and mean occupied counts, then refined by bisection until it is known to
+    within tolerance counts. Returns thresholds of shape (...).
+    """
+    empty_mean = np.sum(np.exp(empty[0])*empty[1], axis=-1)
+    occupied_mean = np.sum(np.exp(occupied[0])*occupied[1], axis=-1)
+
+    # the error rate falls while empty sites are more likely, and rises after
+    def slope(counts):
+        return (np.log(p_filled) + get_log_density(counts, *occupied)
+                - np.log(1 - p_filled) - get_log_density(counts, *empty))
+
+    steps = np.linspace(0, 1, n_points)
+    grid = empty_mean[..., np.newaxis] + steps*(occupied_mean - empty_mean)[..., np.newaxis]
+    rising = slope(grid) > 0
+
+    # first grid point past the crossing, where occupied sites become more likely
+    first = np.clip(np.argmax(rising, axis=-1), 1, n_points - 1)
+    low = np.take_along_axis(grid, first[..., np.newaxis] - 1, axis=-1)
+    high = np.take_along_axis(grid, first[..., np.newaxis], axis=-1)
+
+    while np.max(high - low) > tolerance:
+        mid = 0.5*(low + high)
+        above = slope(mid) > 0
+        high = np.where(above, mid, high)
+        low = np.where(above, low, mid)
+
+    return 0.5*(low + high)[..., 0]
+
+
+def sample_exceedance(threshold, camera, n_photons, psf_fraction, n_pixels, n_samples=10000,
+                      below=False, rng=None):
+    """
+    Estimates the probability that summed counts lie above threshold (or at
+    or below it, if below) by importance sampling the noise model of
+    get_count_components.
+
+    Photon and dark electron numbers and the readout noise are drawn from
+    exponentially tilted distributions whose mean counts sit at the
+    threshold, so that rare errors are sampled about half of the time, and
+    every draw is reweighted by its likelihood ratio. The estimate stays
+    unbiased while its relative error no longer grows as the probability
+    shrinks.
+
+    The draws are box sums of the aperture model, not simulated frames: the
+    per-pixel conversion to uint16 only enters as its mean shift and
+    variance, saturation is ignored, and photons are poissonian around their
+    expected numbers, as in the 'expected' mode of Experiment.image_atoms.
+    Estimates therefore check the model for rare errors, they do not
+    replace simulating a particular detector.
+
+    Parameters
+    ----------
+    threshold : float or ndarray
+        Threshold on summed counts, including the signal offset.
+    camera : IxonUltra888
+        Camera providing the noise model.
+    n_photons : float
+        Mean number of photons reaching the camera from one atom. Use 0 for
+        an empty site.
+    psf_fraction : float or ndarray
+        Fraction of the photons landing inside the aperture.
+    n_pixels : int or ndarray
+        Number of pixels in the aperture.
+    n_samples : int, optional
+        Number of draws per aperture. The default is 10000.
+    below : bool, optional
+        Estimate the probability of counts at or below threshold instead.
+        The default is False.
+    rng : numpy.random.Generator, optional
+        Generator of the draws. The default is a freshly seeded one.
+
+    Returns
+    -------
+    probability : ndarray
+        Estimated probability, of the broadcast shape of the inputs.
+    std_error : ndarray
+        Standard error of the estimate.
+
+    """
+    threshold, psf_fraction, n_pixels = np.broadcast_arrays(np.asarray(threshold, dtype=float),
+                                                            np.asarray(psf_fraction, dtype=float),
+                                                            np.asarray(n_pixels, dtype=float))
+    photons = n_photons * psf_fraction
+    dark = (camera.dark_charge + camera.clock_induced_charge_occurence) * n_pixels
+
+    # counts per photon and dark electron, baseline and gaussian width
+    a = camera.quantum_efficiency * camera.gain / camera.sensitivity
+    b = noise_factor * camera.gain / camera.sensitivity
+    baseline = n_pixels*(camera.signal_offset - 0.5)
+    variance = n_pixels*((camera.single_pixel_noise/camera.sensitivity)**2 + 1/12)
+
+    def tilted_mean(theta):
+        with np.errstate(over='ignore'):
+            return baseline + a*photons*np.exp(theta*a) + b*dark*np.exp(theta*b) + theta*variance
+
+    # the gaussian term alone overshoots, bracketing the tilt between it and 0
+    theta_gauss = (threshold - tilted_mean(0)) / variance
+    low = np.minimum(theta_gauss, 0)
+    high = np.maximum(theta_gauss, 0)
+    for _ in range(60):
+        theta = 0.5*(low + high)
+        above = tilted_mean(theta) > threshold
+        high = np.where(above, theta, high)
+        low = np.where(above, low, theta)
+    theta = 0.5*(low + high)[..., np.newaxis]
+
+    # draws from the tilted distributions
+    rng = np.random.default_rng() if rng is None else rng
+    shape = threshold.shape + (n_samples,)
+    k = rng.poisson(photons[..., np.newaxis]*np.exp(theta*a), shape)
+    d = rng.poisson(dark[..., np.newaxis]*np.exp(theta*b), shape)
+    g = rng.normal(theta*variance[..., np.newaxis], np.sqrt(variance)[..., np.newaxis], shape)
+    signal = a*k + b*d + g
+
+    # likelihood ratio of the nominal to the tilted distributions
+    log_cumulant = (photons[..., np.newaxis]*np.expm1(theta*a) + dark[..., np.newaxis]*np.expm1(theta*b)
+                    + 0.5*theta**2*variance[..., np.newaxis])
+    weights = np.exp(log_cumulant - theta*signal)
+
+    if below:
+        hits = baseline[..., np.newaxis] + signal <= threshold[..., np.newaxis]
+    else:
+        hits = baseline[..., np.newaxis] + signal > threshold[..., np.newaxis]
+    samples = weights*hits
+
+    return np.mean(samples, axis=-1), np.std(samples, axis=-1, ddof=1)/np.sqrt(n_samples)
+
+
+def predict_fidelity(camera, n_photons, psf_fraction, n_pixels, p_filled=0.5, background=0,
+                     threshold=None, method='analytic', n_samples=10000, confidence=0.95, rng=None):
+    """
+    Predicts the detection fidelity of sites classified by thresholding their
+    summed counts, from the noise model of get_count_components rather than
+    simulated shots. Error rates are either integrated from the count
+    mixtures or, for checking rare errors independently of the mixture
+    truncation, estimated by importance sampling with sample_exceedance.
+
+    Parameters
+    ----------
+    camera : IxonUltra888
+        Camera providing the noise model.
+    n_photons : float
+        Mean number of photons reaching the camera from one atom, e.g. from
+        Experiment.get_n_photons.
+    psf_fraction : float or ndarray
+        Fraction of an atom's photons landing inside each site's aperture,
+        e.g. from get_psf_fraction.
+    n_pixels : int or ndarray
+        Number of pixels in each site's aperture.
+    p_filled : float, optional
+        Probability of a site being occupied. The default is 0.5.
+    background : float, optional
+        Counts per pixel subtracted from the thresholds, as for
+        DetectionBot.set_site_boxes. The default is 0.
+    threshold : float or ndarray, optional
+        Thresholds to evaluate, net of background. The default is the
+        threshold minimizing the classification error.
+    method : str, optional
+        Can be 'analytic' or 'importance'. The default is 'analytic'.
+    n_samples : int, optional
+        Number of draws per site type and occupation for the 'importance'
+        method. The default is 10000.
+    confidence : float, optional
+        Confidence of the fidelity interval of the 'importance' method. The
+        default is 0.95.
+    rng : numpy.random.Generator, optional
+        Generator of the 'importance' draws, see sample_exceedance.
+
+    Returns
+    -------
+    prediction : dict
+        Arrays of the broadcast shape of psf_fraction and n_pixels for
+        'threshold', 'false_positive' (empty sites read as occupied),
+        'false_negative' (occupied sites read as empty) and 'fidelity', as
+        for histograms.get_thresholds. Error rates are fractions of all
+        sites. The 'importance' method adds the standard error
+        'fidelity_std' and the bounds 'fidelity_lower' and 'fidelity_upper'
+        of a normal confidence interval.
+
+    """
+    if method not in ['analytic', 'importance']:
+        raise Exception('Method must be analytic or importance.')
+
+    columns = [psf_fraction, n_pixels] if threshold is None else [psf_fraction, n_pixels, threshold]
+    columns = np.broadcast_arrays(*[np.asarray(column, dtype=float) for column in columns])
+    site_shape = columns[0].shape
+
+    # sites with the same aperture and threshold share their distributions
+    keys, groups = np.unique(np.column_stack([np.ravel(column) for column in columns]),
+                             axis=0, return_inverse=True)
+    groups = groups.reshape(site_shape)
+    fractions, areas = keys[:, 0], keys[:, 1]
+
+    empty = get_count_components(camera, 0, fractions, areas)
+    occupied = get_count_components(camera, n_photons, fractions, areas)
+
+    if threshold is None:
+        counts = get_optimal_threshold(empty, occupied, p_filled=p_filled)
+    else:
+        counts = keys[:, 2] + background*areas
+
+    prediction = {'threshold': counts - background*areas}
+    if method == 'analytic':
+        false_positive = (1 - p_filled)*get_exceedance(counts, *empty)
+        false_negative = p_filled*(1 - get_exceedance(counts, *occupied))
+    else:
+        false_positive, positive_std = sample_exceedance(counts, camera, 0, fractions, areas,
+                                                         n_samples=n_samples, rng=rng)
+        false_negative, negative_std = sample_exceedance(counts, camera, n_photons, fractions, areas,
+                                                         n_samples=n_samples, below=True, rng=rng)
+        false_positive *= 1 - p_filled
+        false_negative *= p_filled
+
+        fidelity_std = np.sqrt(((1 - p_filled)*positive_std)**2 + (p_filled*negative_std)**2)
+        z = ndtri(0.5 + 0.5*confidence)
+        prediction['fidelity_std'] = fidelity_std
+        prediction['fidelity_lower'] = 1 - false_positive - false_negative - z*fidelity_std
+        prediction['fidelity_upper'] = 1 - false_positive - false_negative + z*fidelity_std
+
+    prediction['false_positive'] = false_positive
+    prediction['false_negative'] = false_negative
+    prediction['fidelity'] = 1 - false_positive - false_negative
+
+    return {key: value[groups] for key, value in prediction.items()}
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps of simulated experiments over a process pool.
+"""
+
+import os
+import json
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .experiment import Experiment, copy_options, get_option, has_option, option_steps, set_option
+
+
+def get_grid_points(grid):
+    """
+    Returns every combination of the values of a grid, a dict mapping keys to
+    lists of values, as a list of dicts. The last key varies fastest.
+    """
+    keys = list(grid)
+
+    return [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+
+
+def get_option_keys(options, keys):
+    """
+    Returns the grid keys that override an option. Dotted keys must name an
+    entry of the options, or an option Experiment accepts whose parent dict
+    is present, e.g. 'imaging_options.camera_options.roi'. Undotted keys not
+    in the options are free parameters.
+    """
+    option_keys = []
+    for key in keys:
+        if has_option(options, key):
+            option_keys.append(key)
+        elif '.' in key:
+            if key not in option_steps or not isinstance(get_option(options, key.rpartition('.')[0]), dict):
+                raise Exception(f'Invalid option {key}')
+            option_keys.append(key)
+
+    return option_keys
+
+
+def run_point(options, evaluate, point, seed):
+    """
+    Builds the experiment of one grid point and evaluates it. Grid keys that
+    name an option override it, the others are only passed on to evaluate.
+    """
+    options = copy_options(options)
+    for key in get_option_keys(options, point):
+        set_option(options, key, point[key])
+
+    experiment = Experiment(**options, seed=seed)
+
+    return evaluate(experiment, point)
+
+
+def run_sweep(options, grid, evaluate, n_workers=None, seed=None, checkpoint=None):
+    """
+    Evaluates an experiment at every point of a parameter grid, spreading the
+    points over a pool of processes.
+
+    Parameters
+    ----------
+    options : dict
+        Experiment options shared by all points, e.g. testing/options.py.
+    grid : dict
+        Maps keys to lists of values. Dotted keys name an option, e.g.
+        'imaging_options.camera_options.readout_rate', and override it;
+        invalid dotted keys raise. Undotted keys that are not options, e.g.
+        'imaging_time', are only passed on to evaluate. Values can be
+        numbers, strings, numeric sequences such as n_sites tuples, or dicts
+        of these.
+    evaluate : callable
+        Called as evaluate(experiment, point) with the seeded Experiment of a
+        point and the dict of its grid values. Returns a dict of scalar
+        results, with the same keys for every point. Must be picklable, i.e.
+        defined at module level.
+    n_workers : int, optional
+        Number of processes. 1 runs in this process. The default is the
+        number of CPUs.
+    seed : int or SeedSequence, optional
+        Root seed. Every point gets its own child stream, fixed by its index
+        in the grid, so results do not depend on scheduling or resuming.
+        The default draws fresh entropy, or reuses that of the checkpoint.
+    checkpoint : str, optional
+        JSON lines file starting with the root seed, to which every finished
+        point is appended. Points already in the file are not run again, so
+        an interrupted sweep resumes where it stopped; a partly written last
+        line is discarded.
+
+    Returns
+    -------
+    table : ndarray
+        Structured array with one row per grid point, in grid order, and one
+        field per grid key and result key. Fields of non-scalar values, e.g.
+        n_sites, have object dtype.
+
+    """
+    points = get_grid_points(grid)
+    get_option_keys(options, grid)
+    for point in points:
+        to_json(point)
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    state = get_seed_state(seed_sequence)
+
+    results = {}
+    lines = read_checkpoint(checkpoint) if checkpoint is not None else []
+    if lines:
+        # the stored root seed, which a given seed must match
+        stored = json.loads(lines[0])['seed']
+        if seed is not None and stored != state:
+            raise Exception(f'Checkpoint {checkpoint} was written with a different seed.')
+        state = stored
+
+        for line in lines[1:]:
+            entry = json.loads(line)
+            if entry['point'] != to_json(points[entry['index']]):
+                raise Exception(f'Checkpoint {checkpoint} was written for a different grid.')
+            results[entry['index']] = entry['result']
+    elif checkpoint is not None:
+        with open(checkpoint, 'w') as f:
+            f.write(json.dumps({'seed': state}) + '\n')
+
+    seeds = np.random.SeedSequence(state['entropy'], spawn_key=state['spawn_key']).spawn(len(points))
+
+    def record(index, result):
+        results[index] = to_json(result)
+        if checkpoint is not None:
+            with open(checkpoint, 'a') as f:
+                entry = {'index': index, 'point': to_json(points[index]), 'result': results[index]}
+                f.write(json.dumps(entry) + '\n')
+
+    pending = [index for index in range(len(points)) if index not in results]
+
+    if n_workers == 1:
+        for index in pending:
+            record(index, run_point(options, evaluate, points[index], seeds[index]))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(run_point, options, evaluate, points[index], seeds[index]): index
+                       for index in pending}
+            for future in as_completed(futures):
+                record(futures[future], future.result())
+
+    return get_table(points, [results[index] for index in range(len(points))])
+
+
+def read_checkpoint(checkpoint):
+    """
+    Returns the complete, non-empty lines of a checkpoint file, cutting off a
+    last line that was only partly written.
+    """
+    if not os.path.exists(checkpoint):
+        return []
+
+    with open(checkpoint) as f:
+        text = f.read()
+    complete = text[:text.rfind('\n') + 1]
+    if complete != text:
+        with open(checkpoint, 'w') as f:
+            f.write(complete)
+
+    return [line for line in complete.splitlines() if line.strip()]
+
+
+def get_seed_state(seed_sequence):
+    """
+    Returns the entropy and spawn key of a SeedSequence as plain python values.
+    """
+    return {'entropy': seed_sequence.entropy, 'spawn_key': list(seed_sequence.spawn_key)}
+
+
+def to_json(values):
+    """
+    Converts a dict of numpy or python scalars, numeric sequences and dicts
+    of these to plain python values.
+    """
+    json_values = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            json_values[key] = to_json(value)
+            continue
+
+        array = np.asarray(value)
+        if array.dtype.kind not in 'biufU':
+            raise Exception(f'Unsupported value {value!r} of {key}')
+        json_values[key] = array.tolist()
+
+    return json_values
+
+
+def get_column(values):
+    """
+    Returns a table column, of object dtype unless all values are scalars.
+    """
+    if all(np.ndim(value) == 0 and not isinstance(value, dict) for value in values):
+        return np.array(values)
+
+    column = np.empty(len(values), dtype=object)
+    for k, value in enumerate(values):
+        column[k] = value
+
+    return column
+
+
+def get_table(points, results):
+    """
+    Combines grid points and their results into a structured array.
+    """
+    rows = [tuple(point.values()) + tuple(result.values()) for point, result in zip(points, results)]
+    names = list(points[0]) + list(results[0])
+    columns = [get_column([row[i] for row in rows]) for i in range(len(names))]
+
+    dtype = [(name, column.dtype) for name, column in zip(names, columns)]
+    table = np.empty(len(rows), dtype=dtype)
+    for name, column in zip(names, columns):
+        table[name] = column
+
+    return table
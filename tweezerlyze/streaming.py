@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous detection over streams of camera frames, with ring buffers.
+"""
+
+import asyncio
+import numpy as np
+from collections import deque
+from time import perf_counter
+
+
+class DetectionStream():
+    def __init__(self, bot, threshold, n_buffer=64, policy='block', method='weights'):
+        """
+        Runs a DetectionBot continuously over a stream of frames, keeping every
+        frame and occupancy mask in preallocated ring buffers so memory stays
+        flat over arbitrarily long runs.
+
+        Parameters
+        ----------
+        bot : DetectionBot
+            Detection bot with the site method already set up.
+        threshold : float or ndarray
+            Signal threshold in camera counts, either global or per site.
+        n_buffer : int, optional
+            Number of slots in the ring buffers. The default is 64.
+        policy : str, optional
+            What to do when frames arrive faster than they are classified,
+            can be 'block' (stop reading the source until a slot frees up) or
+            'drop' (discard the oldest unclassified frame). Only applies to
+            asynchronous sources. The default is 'block'.
+        method : str, optional
+            Site signal method passed to DetectionBot.get_site_signals. The
+            default is 'weights'.
+        """
+        if policy not in ['block', 'drop']:
+            raise Exception('Policy must be block or drop.')
+        if bot.site_shape is None:
+            raise Exception('Must set up a site method on the bot before streaming.')
+
+        self.bot = bot
+        self.threshold = threshold
+        self.n_buffer = n_buffer
+        self.policy = policy
+        self.method = method
+
+        # ring buffers, allocated on the first frame
+        self.frames = None
+        self.masks = None
+        self.timestamps = np.zeros(n_buffer)
+
+        # counters
+        self.frames_received = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+
+    def allocate(self, frame):
+        self.frames = np.zeros((self.n_buffer,) + np.shape(frame), dtype=np.asarray(frame).dtype)
+        self.masks = np.zeros((self.n_buffer,) + self.bot.site_shape, dtype=bool)
+
+    def receive(self, item, slot):
+        """
+        Copy a frame, or a (timestamp, frame) tuple, into a ring buffer slot.
+        """
+        if isinstance(item, tuple):
+            timestamp, frame = item
+        else:
+            timestamp, frame = perf_counter(), item
+
+        if self.frames is None:
+            self.allocate(frame)
+
+        self.frames[slot] = frame
+        self.timestamps[slot] = timestamp
+        self.frames_received += 1
+
+    def process(self, slot):
+        signals = self.bot.get_site_signals(self.frames[slot], method=self.method)
+        np.greater(signals, self.threshold, out=self.masks[slot])
+        self.frames_processed += 1
+
+        return self.timestamps[slot], self.masks[slot]
+
+    def run(self, frames):
+        """
+        Classify frames from an iterator, e.g. replay_frames or
+        acquire_frames.
+
+        Yields (timestamp, mask) tuples. The mask is a view into the ring
+        buffer and is overwritten n_buffer frames later, so copy it if it has
+        to be kept.
+        """
+        for item in frames:
+            slot = self.frames_received % self.n_buffer
+            self.receive(item, slot)
+
+            yield self.process(slot)
+
+    async def arun(self, frames):
+        """
+        Classify frames from an asynchronous iterator. Frames are read in a
+        separate task, so a source that outruns the classification is either
+        held back or has its oldest pending frames dropped, depending on
+        policy.
+
+        Yields (timestamp, mask) tuples. The mask is a view into the ring
+        buffer and is only valid until the next tuple is requested.
+        """
+        free_slots = deque(range(self.n_buffer))
+        pending = deque()
+        slot_freed = asyncio.Event()
+        frame_ready = asyncio.Event()
+        done = False
+
+        async def read():
+            nonlocal done
+            try:
+                async for item in frames:
+                    while not free_slots:
+                        if self.policy == 'drop' and pending:
+                            free_slots.append(pending.popleft())
+                            self.frames_dropped += 1
+                        else:
+                            slot_freed.clear()
+                            await slot_freed.wait()
+
+                    slot = free_slots.popleft()
+                    self.receive(item, slot)
+                    pending.append(slot)
+                    frame_ready.set()
+            finally:
+                done = True
+                frame_ready.set()
+
+        reader = asyncio.ensure_future(read())
+
+        try:
+            while True:
+                if not pending:
+                    if done:
+                        break
+                    frame_ready.clear()
+                    await frame_ready.wait()
+                    continue
+
+                slot = pending.popleft()
+                yield self.process(slot)
+
+                free_slots.append(slot)
+                slot_freed.set()
+        finally:
+            reader.cancel()
+
+        # surface errors raised by the source
+        if reader.done() and not reader.cancelled() and reader.exception():
+            raise reader.exception()
+
+
+def replay_frames(filename, loop=False):
+    """
+    Yields the frames of a saved (n_frames, H, W) stack without loading the
+    whole file into memory.
+    """
+    frames = np.load(filename, mmap_mode='r')
+
+    while True:
+        for frame in frames:
+            yield frame
+
+        if not loop:
+            break
+
+
+def acquire_frames(acquire, n_frames=None):
+    """
+    Yields the frames returned by acquire, a callable that takes a new
+    exposure and returns it, n_frames times or forever. For a simulated
+    experiment, acquire can load and image atoms and then return
+    camera.grab_image(); grab_image alone only repeats the last exposure.
+    """
+    count = 0
+    while n_frames is None or count < n_frames:
+        yield acquire()
+        count += 1
@@ -1,6 +1,6 @@
 import os
 import sys
-fp = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+fp = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, fp)
 
-import simulation, detection, sorting
\ No newline at end of file
+from tweezerlyze import simulation, detection, sorting
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the on-disk result cache.
+"""
+
+import os
+import tempfile
+import unittest
+import numpy as np
+from .context import detection
+from .test_detection import make_lattice_image
+from .test_simulation import make_options, make_bot
+from tweezerlyze import cache
+from tweezerlyze.simulation.experiment import Experiment
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = cache.Cache(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hash(self):
+        options = make_options()
+        reordered = dict(reversed(list(make_options().items())))
+        self.assertEqual(cache.get_hash(options, 0), cache.get_hash(reordered, 0))
+        self.assertNotEqual(cache.get_hash(options, 0), cache.get_hash(options, 1))
+
+        changed = make_options()
+        changed['imaging_options']['camera_options']['gain'] = 200
+        self.assertNotEqual(cache.get_hash(options, 0), cache.get_hash(changed, 0))
+        self.assertNotEqual(cache.get_hash(np.zeros(4)), cache.get_hash(np.zeros(5)))
+
+        # large integer seeds hash exactly, equal ints and floats agree
+        self.assertNotEqual(cache.get_hash(options, 2**60), cache.get_hash(options, 2**60 + 1))
+        self.assertNotEqual(cache.get_hash(np.int64(2**60)), cache.get_hash(np.int64(2**60 + 1)))
+        self.assertEqual(cache.get_hash(1), cache.get_hash(1.0))
+        self.assertNotEqual(cache.get_hash(0.1), cache.get_hash(np.nextafter(0.1, 1)))
+
+    def test_lru_eviction(self):
+        entries = cache.Cache(self.directory.name, max_size=3*(8*100 + 128))
+        for k in range(3):
+            entries.save(f'entry-{k}', np.full(100, k, dtype=float))
+            os.utime(entries.get_path(f'entry-{k}'), (k, k))
+
+        # reading entry 0 makes entry 1 the least recently used
+        np.testing.assert_array_equal(entries.load('entry-0'), np.zeros(100))
+        entries.save('entry-3', {'a': np.ones(100)})
+
+        self.assertIsNone(entries.load('entry-1'))
+        self.assertIsNotNone(entries.load('entry-0'))
+        np.testing.assert_array_equal(entries.load('entry-3')['a'], np.ones(100))
+        self.assertLessEqual(entries.get_size(), entries.max_size)
+
+    def test_reference_image(self):
+        options = make_options()
+        image = cache.get_reference_image(options, seed=3, cache=self.cache)
+        again = cache.get_reference_image(make_options(), seed=3, cache=self.cache)
+        np.testing.assert_array_equal(image, again)
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+        # a different seed renders a new image
+        other = cache.get_reference_image(options, seed=4, cache=self.cache)
+        self.assertFalse(np.array_equal(image, other))
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+    def test_calibration_and_tables(self):
+        mask = np.ones((6, 5), dtype=bool)
+        image = make_lattice_image(mask, spacing=7, origin=(5.3, 6.6), shape=(64, 48))
+
+        first = detection.DetectionBot()
+        second = detection.DetectionBot()
+        cache.calibrate_lattice(first, image, cache=self.cache, min_sigma=1.5, max_sigma=1.5)
+        cache.calibrate_lattice(second, image, cache=self.cache, min_sigma=1.5, max_sigma=1.5)
+        np.testing.assert_array_equal(first.lattice_vectors, second.lattice_vectors)
+        np.testing.assert_array_equal(first.reference_pixels, second.reference_pixels)
+
+        expt = Experiment(**make_options(), seed=5)
+        camera, sigma = expt.imaging.camera, expt.get_psf_sigma()
+        direct = make_bot(expt, (4, 4))
+        direct.set_likelihood_table(camera, 150, sigma)
+
+        for _ in range(2):
+            bot = make_bot(expt, (4, 4))
+            cache.set_likelihood_table(bot, camera, 150, sigma, cache=self.cache)
+            np.testing.assert_array_equal(bot.likelihood_tables, direct.likelihood_tables)
+            self.assertEqual(bot.likelihood_bin_width, direct.likelihood_bin_width)
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
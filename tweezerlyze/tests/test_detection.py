@@ -6,12 +6,187 @@ Created on Sun May 24 15:13:00 2020
 """
 
 import unittest
+import numpy as np
 from .context import detection, simulation, sorting
+from .test_simulation import make_options, make_bot as make_experiment_bot
+from tweezerlyze.simulation.experiment import Experiment
+
+
+def make_lattice_image(mask, spacing=8, origin=(6, 6), sigma=1.5, amplitude=200,
+                       offset=500, shape=(50, 50), seed=0, angle=0):
+    """
+    Renders gaussian spots for the occupied sites of mask on a noisy background.
+    """
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    image = offset + rng.normal(0, 3, shape)
+    for i, j in zip(*np.nonzero(mask)):
+        cx = origin[0] + i*spacing + j*spacing*np.sin(angle)
+        cy = origin[1] + j*spacing*np.cos(angle)
+        image += amplitude*np.exp(-0.5*((x-cx)**2 + (y-cy)**2)/sigma**2)
+        
+    return image.astype('uint16')
+
+
+def make_bot(spacing=8, origin=(6, 6)):
+    bot = detection.DetectionBot()
+    bot.set_spacing([spacing, spacing])
+    bot.reference_pixels = np.array(origin, dtype=float)
+    bot.reference_tuple = (0, 0)
+    
+    return bot
+
 
 class TestDetection(unittest.TestCase):
 
     def test_something(self):
         return
+    
+    def test_site_weights(self):
+        mask = np.random.default_rng(1).random((5, 5)) > 0.5
+        image = make_lattice_image(mask)
+        
+        bot = make_bot()
+        bot.set_site_weights(mask.shape, sigma=1.5, shape=image.shape)
+        bot.set_site_mask(image, threshold=550)
+        
+        np.testing.assert_array_equal(bot.blob_mask, mask)
+
+    def test_site_masks(self):
+        rng = np.random.default_rng(2)
+        masks = rng.random((7, 5, 5)) > 0.5
+        frames = np.array([make_lattice_image(m, seed=k) for k, m in enumerate(masks)])
+        
+        bot = make_bot()
+        bot.set_site_weights((5, 5), sigma=1.5, shape=frames.shape[1:])
+        found, signals = bot.get_site_masks(frames, threshold=550, chunk_size=3)
+        
+        np.testing.assert_array_equal(found, masks)
+        np.testing.assert_allclose(signals[4], bot.get_site_signals(frames[4]), rtol=1e-5)
+
+    def test_blob_mask_bounds(self):
+        bot = make_bot()
+        bot.blob_indices = np.array([[0, 0], [-1, 2], [2, 3], [4, 1], [1, 5]])
+        mask = bot.set_blob_mask((4, 4))
+        
+        expected = np.zeros((4, 4), dtype=bool)
+        expected[0, 0] = expected[2, 3] = True
+        np.testing.assert_array_equal(mask, expected)
+        np.testing.assert_array_equal(bot.dropped_blobs, [1, 3, 4])
+        
+        bot.blob_indices = np.array([[3, 3]])
+        self.assertIs(bot.set_blob_mask((4, 4)), mask)
+        self.assertEqual(np.count_nonzero(mask), 1)
+
+    def test_matched_filter(self):
+        mask = np.random.default_rng(4).random((5, 5)) > 0.5
+        image = make_lattice_image(mask, amplitude=40, sigma=1.5)
+        
+        bot = make_bot()
+        bot.set_matched_filter(1.5, shape=image.shape, n_sites=mask.shape)
+        np.testing.assert_array_equal(bot.set_site_mask(image, 515, method='matched'), mask)
+        
+        positions, sizes = bot.get_blob_pixels(image, method='matched', threshold=15)
+        np.testing.assert_array_equal(np.sort(bot.get_blob_indices(positions), axis=0),
+                                      np.sort(np.argwhere(mask), axis=0))
+
+    def test_box_signals(self):
+        mask = np.random.default_rng(5).random((5, 5)) > 0.5
+        image = make_lattice_image(mask)
+        
+        bot = make_bot()
+        bot.set_site_boxes(mask.shape, half_width=2, shape=image.shape, background=500)
+        signals = bot.get_site_signals(image, method='box')
+        
+        self.assertEqual(signals[1, 2] + 500*25, np.sum(image[12:17, 20:25], dtype=int))
+        np.testing.assert_array_equal(signals > 1000, mask)
+        np.testing.assert_array_equal(bot.get_site_signals(np.stack([image, image]), method='box')[1], signals)
+
+    def test_site_windows(self):
+        mask = np.random.default_rng(6).random((5, 5)) > 0.5
+        image = make_lattice_image(mask)
+        
+        bot = make_bot()
+        bot.set_site_windows(mask.shape, half_width=2, shape=image.shape)
+        windows = bot.get_site_windows(image)
+        
+        self.assertEqual(windows.shape, (5, 5, 5, 5))
+        self.assertTrue(np.shares_memory(windows, image))
+        np.testing.assert_array_equal(windows[1, 2], image[12:17, 20:25])
+        
+        # off-grid lattices fall back to a gather with the same layout
+        bot.set_spacing([8.3, 8])
+        bot.set_site_windows(mask.shape, half_width=2, shape=image.shape)
+        windows = bot.get_site_windows(np.stack([image, image]))
+        
+        self.assertEqual(windows.shape, (2, 5, 5, 5, 5))
+        np.testing.assert_array_equal(windows[1, 1, 2], image[12:17, 20:25])
+
+    def test_calibrate_lattice(self):
+        mask = np.ones((6, 5), dtype=bool)
+        mask[0, 0] = False
+        image = make_lattice_image(mask, spacing=7, origin=(5.3, 6.6), angle=0.1, shape=(64, 48))
+        
+        bot = detection.DetectionBot()
+        lattice_vectors, origin = bot.calibrate_lattice(image, min_sigma=1.5, max_sigma=1.5)
+        
+        expected = 7*np.array([[1, np.sin(0.1)], [0, np.cos(0.1)]])
+        np.testing.assert_allclose(lattice_vectors, expected, atol=0.1)
+        np.testing.assert_allclose(origin, (5.3, 6.6), atol=0.3)
+        
+        # the transform is shared with the fixed-lattice detectors
+        bot.set_site_weights(mask.shape, sigma=1.5)
+        np.testing.assert_array_equal(bot.set_site_mask(image, 550), mask)
+
+    def test_uncalibrated_lattice(self):
+        bot = detection.DetectionBot()
+        bot.reference_pixels = np.zeros(2)
+        self.assertIsNone(bot.inverse_lattice_vectors)
+        with self.assertRaises(Exception):
+            bot.get_blob_indices(np.ones((3, 2)))
+
+    def test_track_drift(self):
+        rng = np.random.default_rng(7)
+        bot = make_bot()
+        bot.set_site_weights((5, 5), sigma=1.5, shape=(50, 50))
+        
+        for k in range(60):
+            mask = rng.random((5, 5)) > 0.3
+            image = make_lattice_image(mask, origin=(6.4, 5.7), seed=k)
+            found = bot.set_site_mask(image, 550).copy()
+            bot.track_drift(image=image, mask=found, alpha=0.2, half_width=3)
+            
+        np.testing.assert_allclose(bot.reference_pixels, (6.4, 5.7), atol=0.1)
+        
+        # weights shifted in place match freshly built ones
+        shifted = bot.site_weights.toarray()
+        bot.set_site_weights((5, 5), sigma=1.5, shape=(50, 50))
+        np.testing.assert_allclose(shifted, bot.site_weights.toarray(), atol=0.01)
+
+    def test_likelihood_table(self):
+        expt = Experiment(**make_options())
+        n_photons = expt.get_n_photons(20000)
+        
+        bot = make_experiment_bot(expt, (4, 4))
+        bot.set_likelihood_table(expt.imaging.camera, n_photons, expt.get_psf_sigma())
+        
+        errors = []
+        for _ in range(20):
+            expt.load_atoms()
+            expt.image_atoms(20000)
+            found = bot.set_site_mask(expt.imaging.camera.image, 0, method='likelihood')
+            errors.append(found != expt.geometry.gt_mask)
+        
+        self.assertLess(np.mean(errors), 0.05)
+        
+        # shifting the sites across the frame edge rebuilds the tables
+        areas = bot.box_areas.copy()
+        bot.reference_pixels = bot.reference_pixels - 9
+        bot.shift_sites()
+        self.assertFalse(np.array_equal(bot.box_areas, areas))
+        starts = bot.likelihood_starts
+        bot.set_likelihood_table(expt.imaging.camera, n_photons, expt.get_psf_sigma())
+        np.testing.assert_array_equal(starts, bot.likelihood_starts)
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
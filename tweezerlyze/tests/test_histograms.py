@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the per-site histogram calibration.
+"""
+
+import unittest
+import numpy as np
+from .context import detection
+from .test_detection import make_lattice_image, make_bot
+from tweezerlyze import histograms
+
+
+class TestHistograms(unittest.TestCase):
+
+    def test_fit_bimodal(self):
+        rng = np.random.default_rng(8)
+        occupied = rng.random((4000, 3, 4)) < 0.6
+        means = np.where(occupied, 300 + 10*np.arange(4), 0)
+        counts = rng.normal(means, np.where(occupied, 40, 25))
+        
+        fit = histograms.fit_bimodal(counts)
+        np.testing.assert_allclose(fit['means'][1], 300 + 10*np.arange(4)*np.ones((3, 1)), atol=5)
+        np.testing.assert_allclose(fit['stds'][0], 25, atol=2)
+        np.testing.assert_allclose(fit['weights'][1], 0.6, atol=0.03)
+        
+        thresholds = histograms.get_thresholds(fit)
+        errors = np.mean((counts > thresholds['threshold']) != occupied, axis=0)
+        np.testing.assert_allclose(errors, 1 - thresholds['fidelity'], atol=0.01)
+        self.assertTrue(np.all(thresholds['threshold'] > 50) and np.all(thresholds['threshold'] < 250))
+        
+    def test_site_counts(self):
+        rng = np.random.default_rng(9)
+        masks = rng.random((6, 5, 5)) > 0.5
+        shots = np.array([make_lattice_image(m, seed=k) for k, m in enumerate(masks)])
+        
+        bot = make_bot()
+        bot.set_site_boxes((5, 5), half_width=2, shape=shots.shape[1:], background=500)
+        counts = histograms.get_site_counts(shots, bot, chunk_size=4)
+        
+        self.assertEqual(counts.shape, (6, 5, 5))
+        np.testing.assert_array_equal(counts > 1000, masks)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,86 @@ Created on Sun May 24 15:13:00 2020
 @author: Jacob
 """
 
+import os
+import tempfile
 import unittest
+import numpy as np
 from .context import detection, simulation, sorting
+from tweezerlyze.calculation.steck import cesium
+from tweezerlyze.simulation.experiment import Experiment, copy_options
+from tweezerlyze.simulation.optimization import check_fidelity, find_imaging_time, simulate_shots
+from tweezerlyze.simulation.statistics import get_count_components, get_psf_fraction
+from tweezerlyze.simulation.sweeps import run_sweep
+
+
+def make_options(n_sites=(4, 4), avg_filling=0.5, sensor_size=(60, 60)):
+    """
+    Small version of testing/options.py.
+    """
+    return {
+        'atom_options': {
+            'species': cesium,
+            'temperature': 50e-6,
+            },
+        'tweezer_options': {
+            'n_sites': n_sites,
+            'spacing': (25e-6, 25e-6),
+            'angle': 0,
+            'wavelength': 1064e-9,
+            'power': 10e-3,
+            'waist': 6.5e-6,
+            'offset': (0, 0),
+            'avg_filling': avg_filling,
+            'filling_distribution': 'binomial',
+            'filling_distribution_kwargs': {},
+            },
+        'imaging_options': {
+            'camera_options': {
+                'pixel_size': (13.5e-6, 13.5e-6),
+                'sensor_size': sensor_size,
+                'gain': 100,
+                'preamp_setting': 1,
+                'amplifier_type': 'EM',
+                'readout_rate': 30e6,
+                'sensor_temperature': -70+273.15,
+                'exposure_time': 5e-3,
+                'position': (10, 10),
+                },
+            'optics_options': {
+                'magnification': 250/40,
+                'NA': 0.6,
+                },
+            'laser_options': {
+                'wavelength': cesium.D2.wavelength,
+                'power': 1e-3,
+                'waist': 1e-3,
+                },
+            'scattering_rate': 1,
+            },
+        }
+
+
+def make_bot(expt, n_sites, half_width=2):
+    """
+    Detection bot with the lattice of an experiment and site boxes set.
+    """
+    bot = detection.DetectionBot()
+    bot.set_spacing(np.array(expt.geometry.spacing) / expt.imaging.camera.scale)
+    bot.reference_pixels = np.subtract(expt.imaging.camera.position, expt.imaging.camera.origin) - 0.5
+    bot.reference_tuple = (0, 0)
+    bot.set_site_boxes(n_sites, half_width, shape=expt.imaging.camera.image_shape,
+                       background=expt.imaging.camera.signal_offset)
+    
+    return bot
+
+
+def evaluate_shots(expt, point):
+    """
+    Sweep evaluation: mean counts of a few shots and the camera gain used.
+    """
+    frames, masks = expt.generate_shots(4, point['imaging_time'], chunk_size=2)
+    
+    return {'mean': np.mean(frames), 'gain': expt.imaging.camera.gain, 'filling': np.mean(masks)}
 
 
 class TestSimulation(unittest.TestCase):
@@ -14,5 +92,503 @@ class TestSimulation(unittest.TestCase):
     def test_something(self):
         return
 
+    def test_find_imaging_time(self):
+        expt = Experiment(**make_options(), seed=0)
+        bot = make_bot(expt, (4, 4))
+        camera = expt.imaging.camera
+        sigma = expt.get_psf_sigma()
+
+        def detector(frames, imaging_time):
+            bot.set_likelihood_table(camera, expt.get_n_photons(imaging_time), sigma)
+            return bot.get_site_masks(frames, 0, method='likelihood')[0]
+
+        result = find_imaging_time(expt, detector, 0.95, (1e3, 1e5), tolerance=0.2)
+        times = [h[0] for h in result['history']]
+
+        self.assertTrue(1e3 < result['imaging_time'] < 1e5)
+        self.assertIn(result['imaging_time'], times)
+        self.assertLessEqual(result['fidelity_lower'], result['fidelity'])
+        self.assertGreaterEqual(result['fidelity'], 0.9)
+        self.assertEqual(result['n_shots'], sum(h[3] for h in result['history']))
+
+    def test_check_fidelity_batches(self):
+        expt = Experiment(**make_options(), seed=3)
+        batches = []
+
+        def detector(frames, imaging_time):
+            batches.append(frames)
+            return np.ones((len(frames), 4, 4), dtype=bool)
+
+        # every batch of the sequential test is a new set of shots
+        for _ in range(2):
+            check_fidelity(expt, detector, 15000, 0.5, batch_size=20, max_shots=60, confidence=1 - 1e-9,
+                           mode='expected')
+        self.assertEqual(len(batches), 6)
+        for k in range(len(batches)):
+            for l in range(k):
+                self.assertFalse(np.array_equal(batches[k], batches[l]))
+
+    def test_predict_fidelity(self):
+        expt = Experiment(**make_options(n_sites=(3, 4)), seed=1)
+        bot = make_bot(expt, (3, 4))
+        prediction = expt.predict_fidelity(15000)
+
+        self.assertEqual(prediction['threshold'].shape, (3, 4))
+        np.testing.assert_allclose(prediction['fidelity'],
+                                   1 - prediction['false_positive'] - prediction['false_negative'])
+
+        # thresholds apply directly to box signals above the signal offset
+        frames, masks = simulate_shots(expt, 15000, 200)
+        found = bot.get_site_signals(frames, method='box') > prediction['threshold']
+        self.assertAlmostEqual(np.mean(found == masks), np.mean(prediction['fidelity']), delta=0.015)
+
+        # longer imaging only helps
+        self.assertGreater(np.mean(expt.predict_fidelity(30000)['fidelity']), np.mean(prediction['fidelity']))
+
+    def test_importance_sampling(self):
+        expt = Experiment(**make_options(n_sites=(2, 2)), seed=2)
+        analytic = expt.predict_fidelity(40000)
+        sampled = expt.predict_fidelity(40000, method='importance', n_samples=5000)
+
+        # errors far too rare for plain sampling are still resolved to a few percent
+        errors = 1 - analytic['fidelity']
+        self.assertTrue(np.all(errors < 1e-5))
+        np.testing.assert_allclose(1 - sampled['fidelity'], errors, rtol=0.1)
+        self.assertTrue(np.all(sampled['fidelity_std'] < 0.05*errors))
+        self.assertTrue(np.all(sampled['fidelity_lower'] < sampled['fidelity']))
+
+        # a fixed threshold is evaluated as given
+        fixed = expt.predict_fidelity(40000, threshold=analytic['threshold'] + 50)
+        np.testing.assert_allclose(fixed['threshold'], analytic['threshold'] + 50)
+        self.assertGreater(np.min(fixed['false_negative']), np.max(analytic['false_negative']))
+
+    def test_sampled_errors_match_frames(self):
+        expt = Experiment(**make_options(), seed=15)
+        bot = make_bot(expt, (4, 4))
+        sampled = expt.predict_fidelity(15000, method='importance', n_samples=20000)
+
+        # at a moderate error rate, brute force simulation resolves it too
+        frames, masks = expt.generate_shots(4000, 15000, mode='expected')
+        found = bot.get_site_signals(frames, method='box') > sampled['threshold']
+        errors = np.mean(found != masks)
+        std = np.sqrt(errors*(1 - errors)/masks.size + np.mean(sampled['fidelity_std'])**2)
+        self.assertAlmostEqual(errors, 1 - np.mean(sampled['fidelity']), delta=3*std)
+
+    def test_load_atoms(self):
+        expt = Experiment(**make_options(n_sites=(5, 6)), seed=3)
+        atoms, geometry = expt.atoms, expt.geometry
+
+        # sites as Tweezer objects or as positions load the same atoms
+        atoms.load_atoms(geometry.sites, 'poisson', avg_filling=None)
+        first = atoms.atom_positions
+        expt.set_seed(3)
+        atoms.load_atoms(geometry.positions, 'poisson', avg_filling=geometry.avg_filling)
+        np.testing.assert_array_equal(atoms.atom_positions, first)
+        self.assertEqual(atoms.atom_positions.shape[1], np.sum(atoms.occupancies))
+
+        # many shots at once, atoms tagged by shot
+        atoms.load_atoms(geometry.positions, 'poisson', avg_filling=2, n_shots=50)
+        self.assertEqual(atoms.occupancies.shape, (50, 30))
+        np.testing.assert_array_equal(np.bincount(atoms.atom_shots, minlength=50), np.sum(atoms.occupancies, axis=1))
+        shot = atoms.atom_positions[:, atoms.atom_shots == 7]
+        np.testing.assert_array_equal(shot, np.repeat(geometry.positions, atoms.occupancies[7], axis=1))
+        self.assertAlmostEqual(np.mean(atoms.occupancies), 2, delta=0.1)
+
+    def test_expected_image(self):
+        expt = Experiment(**make_options(avg_filling=1), seed=4)
+        bot = make_bot(expt, (4, 4))
+        camera = expt.imaging.camera
+        expt.load_atoms()
+
+        # all photons of atoms well inside the sensor land on it
+        sigma = expt.get_psf_sigma() * camera.scale
+        expected = camera.get_expected_photons(expt.atoms.atom_positions, 100, sigma)
+        self.assertAlmostEqual(np.sum(expected), 100*16, delta=0.01)
+
+        signals = {}
+        for mode in ['photons', 'expected']:
+            signals[mode] = []
+            for _ in range(800):
+                expt.image_atoms(15000, mode=mode)
+                signals[mode].append(bot.get_box_signals(camera.image))
+        self.assertEqual(camera.image.dtype, np.uint16)
+        self.assertAlmostEqual(np.mean(signals['expected']), np.mean(signals['photons']), delta=3)
+
+        with self.assertRaises(Exception):
+            expt.image_atoms(15000, mode='unknown')
+
+    def test_image_statistics(self):
+        expt = Experiment(**make_options(avg_filling=1), seed=16)
+        bot = make_bot(expt, (4, 4))
+        camera = expt.imaging.camera
+        n_photons = expt.get_n_photons(15000)
+
+        signals = {}
+        for mode in ['photons', 'expected']:
+            frames, masks = expt.generate_shots(3000, 15000, mode=mode)
+            signals[mode] = bot.get_site_signals(frames, method='box').reshape(3000, -1)
+
+        # box counts of the expected mode follow the noise model
+        fractions = get_psf_fraction(bot.get_site_pixels((4, 4)), bot.box_corners, expt.get_psf_sigma())
+        log_weights, means, std = get_count_components(camera, n_photons, fractions, bot.box_areas.ravel())
+        weights = np.exp(log_weights)
+        mean = np.sum(weights*means, axis=-1) - camera.signal_offset*bot.box_areas.ravel()
+        variance = np.sum(weights*(means - np.sum(weights*means, axis=-1)[:, np.newaxis])**2, axis=-1) + std**2
+        self.assertAlmostEqual(np.mean(signals['expected']), np.mean(mean), delta=1)
+        self.assertAlmostEqual(np.mean(np.var(signals['expected'], axis=0)), np.mean(variance),
+                               delta=0.03*np.mean(variance))
+
+        # binning a fixed number of photons adds its binomial variance, see image_atoms
+        counts_per_photon = camera.quantum_efficiency*camera.gain/camera.sensitivity
+        excess = np.mean(counts_per_photon**2 * n_photons*fractions*(1 - fractions))
+        self.assertAlmostEqual(np.mean(signals['photons']), np.mean(signals['expected']), delta=1.5)
+        self.assertAlmostEqual(np.mean(np.var(signals['photons'], axis=0) - np.var(signals['expected'], axis=0)),
+                               excess, delta=0.35*excess)
+
+    def test_stream_photons(self):
+        expt = Experiment(**make_options(avg_filling=1), seed=5)
+        bot = make_bot(expt, (4, 4))
+        atoms, camera = expt.atoms, expt.imaging.camera
+        expt.load_atoms()
+
+        # chunks cover every photon exactly once
+        chunks = list(atoms.generate_photon_chunks(expt.imaging.collection_rate, expt.geometry.sigma_thermal,
+                                                   15000, expt.imaging.optics.collection_efficiency,
+                                                   chunk_size=1000))
+        self.assertTrue(all(chunk.shape[1] <= 1000 for chunk in chunks))
+        self.assertEqual(sum(chunk.shape[1] for chunk in chunks), 16*atoms.n_photons)
+
+        incident = np.zeros(camera.sensor_size)
+        for chunk in chunks:
+            camera.bin_photons(chunk, out=incident)
+        self.assertEqual(np.sum(incident), 16*atoms.n_photons)
+
+        signals = {}
+        for mode in ['photons', 'stream']:
+            signals[mode] = []
+            for _ in range(50):
+                expt.image_atoms(15000, mode=mode, max_memory=2**14)
+                signals[mode].append(bot.get_box_signals(camera.image))
+        self.assertAlmostEqual(np.mean(signals['stream']), np.mean(signals['photons']), delta=4)
+
+    def test_camera_roi(self):
+        expt = Experiment(**make_options(avg_filling=1), seed=6)
+        camera = expt.imaging.camera
+        expt.load_atoms()
+        full_time = camera.get_readout_time()
+
+        sigma = expt.get_psf_sigma() * camera.scale
+        full = camera.get_expected_photons(expt.atoms.atom_positions, 100, sigma)
+
+        roi = {'xmin': 5, 'xmax': 50, 'ymin': 4, 'ymax': 48}
+        camera.set_roi(roi, crop_mode=True)
+        self.assertLess(camera.get_readout_time(), full_time)
+
+        # only the sub-array is simulated, in the same place on the sensor
+        expected = camera.get_expected_photons(expt.atoms.atom_positions, 100, sigma)
+        np.testing.assert_allclose(expected, full[5:50, 4:48], atol=1e-12)
+
+        images = []
+        for _ in range(20):
+            expt.image_atoms(15000, mode='stream')
+            images.append(camera.image)
+        self.assertEqual(camera.image.shape, (45, 44))
+
+        # crops are given in sensor pixels
+        crop = camera.crop_image({'xmin': 10, 'xmax': 20, 'ymin': 8, 'ymax': 18})
+        np.testing.assert_array_equal(crop, camera.image[5:15, 4:14])
+        with self.assertRaises(Exception):
+            camera.crop_image({'xmin': 0, 'xmax': 20, 'ymin': 8, 'ymax': 18})
+
+        # detection on the sub-array
+        bot = make_bot(expt, (4, 4))
+        prediction = expt.predict_fidelity(15000, p_filled=0.5)
+        masks = bot.get_site_signals(np.array(images), method='box') > prediction['threshold']
+        self.assertGreater(np.mean(masks), 0.9)
+
+    def test_generate_shots(self):
+        expt = Experiment(**make_options(n_sites=(3, 4)), seed=7)
+        bot = make_bot(expt, (3, 4))
+        prediction = expt.predict_fidelity(15000)
+
+        for mode in ['expected', 'photons']:
+            frames, masks = expt.generate_shots(150, 15000, mode=mode, chunk_size=40)
+            self.assertEqual(frames.shape, (150,) + expt.imaging.camera.image_shape)
+            self.assertEqual(frames.dtype, np.uint16)
+            self.assertEqual(masks.shape, (150, 3, 4))
+
+            # masks line up with the atoms in the frames
+            found = bot.get_site_signals(frames, method='box') > prediction['threshold']
+            self.assertAlmostEqual(np.mean(found == masks), np.mean(prediction['fidelity']), delta=0.02)
+
+        # expected frames do not depend on how many shots are rendered at once
+        blocked = Experiment(**make_options(n_sites=(3, 4)), seed=7)
+        reference = Experiment(**make_options(n_sites=(3, 4)), seed=7)
+        fraction_bytes = 3*4*expt.imaging.camera.image_shape[0]*8
+        np.testing.assert_array_equal(blocked.generate_shots(10, 15000, max_memory=3*fraction_bytes)[0],
+                                      reference.generate_shots(10, 15000)[0])
+
+        # the camera still holds a single frame
+        expt.load_atoms()
+        expt.image_atoms(15000)
+        image = expt.imaging.camera.image
+        expt.generate_shots(5, 15000)
+        self.assertIs(expt.imaging.camera.image, image)
+
+    def test_generate_shots_memmap(self):
+        expt = Experiment(**make_options())
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'shots.npy')
+            frames, masks = expt.generate_shots(10, 15000, filename=filename)
+            frames.flush()
+            np.testing.assert_array_equal(np.load(filename), frames)
+            del frames
+
+    def test_reproducible_shots(self):
+        expt = Experiment(**make_options(), seed=8)
+        frames, masks = expt.generate_shots(40, 15000, mode='photons', chunk_size=10)
+
+        # shards generated separately, in any order, reproduce the run
+        shards = Experiment(**make_options(), seed=8)
+        second = shards.generate_shots(20, 15000, mode='photons', chunk_size=10, first_shot=20)
+        first = shards.generate_shots(20, 15000, mode='photons', chunk_size=10, first_shot=0)
+        np.testing.assert_array_equal(np.concatenate([first[0], second[0]]), frames)
+        np.testing.assert_array_equal(np.concatenate([first[1], second[1]]), masks)
+
+        # consecutive calls continue the run instead of repeating it
+        expt = Experiment(**make_options(), seed=8)
+        first = expt.generate_shots(20, 15000, mode='photons', chunk_size=10)
+        second = expt.generate_shots(20, 15000, mode='photons', chunk_size=10)
+        np.testing.assert_array_equal(np.concatenate([first[0], second[0]]), frames)
+        self.assertEqual(expt.shots_generated, 40)
+
+        expt = Experiment(**make_options())
+        first, second = [expt.generate_shots(5, 15000)[0] for _ in range(2)]
+        self.assertFalse(np.array_equal(first, second))
+
+        with self.assertRaises(Exception):
+            shards.generate_shots(20, 15000, chunk_size=10, first_shot=5)
+
+        # single shots follow the seed, spawned seeds give independent streams
+        images = []
+        for seed in [9, 9] + Experiment(**make_options(), seed=9).spawn_seeds(1):
+            expt = Experiment(**make_options(), seed=seed)
+            expt.load_atoms()
+            expt.image_atoms(15000)
+            images.append(expt.imaging.camera.image)
+        np.testing.assert_array_equal(images[0], images[1])
+        self.assertFalse(np.array_equal(images[0], images[2]))
+
+        # experiments sharing a SeedSequence object give the same shots
+        seed = np.random.SeedSequence(9)
+        shots = [Experiment(**make_options(), seed=seed).generate_shots(5, 15000)[0] for _ in range(2)]
+        np.testing.assert_array_equal(shots[0], shots[1])
+        self.assertEqual(seed.n_children_spawned, 0)
+
+    def test_sweep(self):
+        grid = {
+            'imaging_options.camera_options.gain': [100, 200],
+            'imaging_time': [5000, 20000],
+            }
+        options = make_options()
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'sweep.jsonl')
+            table = run_sweep(options, grid, evaluate_shots, n_workers=1, seed=10, checkpoint=checkpoint)
+
+            # options are overridden per point and results come back in grid order
+            np.testing.assert_array_equal(table['gain'], [100, 100, 200, 200])
+            np.testing.assert_array_equal(table['imaging_time'], [5000, 20000, 5000, 20000])
+            self.assertTrue(np.all(np.diff(table['mean'])[[0, 2]] > 0))
+            self.assertEqual(options['imaging_options']['camera_options']['gain'], 100)
+
+            # resuming from a partial checkpoint only runs the missing points,
+            # dropping a line cut off while writing
+            with open(checkpoint) as f:
+                lines = f.readlines()
+            with open(checkpoint, 'w') as f:
+                f.writelines(lines[:2] + [lines[2][:20]])
+            resumed = run_sweep(options, grid, evaluate_shots, n_workers=2, seed=10, checkpoint=checkpoint)
+            np.testing.assert_array_equal(resumed, table)
+            with open(checkpoint) as f:
+                self.assertEqual(len(f.readlines()), 5)
+
+            with self.assertRaises(Exception):
+                run_sweep(options, {'imaging_time': [1, 2, 3, 4]}, evaluate_shots, n_workers=1,
+                          checkpoint=checkpoint)
+            with self.assertRaises(Exception):
+                run_sweep(options, grid, evaluate_shots, n_workers=1, seed=11, checkpoint=checkpoint)
+
+            # without a seed, a resumed sweep reuses the entropy of its checkpoint
+            checkpoint = os.path.join(directory, 'unseeded.jsonl')
+            table = run_sweep(options, grid, evaluate_shots, n_workers=1, checkpoint=checkpoint)
+            with open(checkpoint) as f:
+                lines = f.readlines()
+            with open(checkpoint, 'w') as f:
+                f.writelines(lines[:3])
+            resumed = run_sweep(options, grid, evaluate_shots, n_workers=1, checkpoint=checkpoint)
+            np.testing.assert_array_equal(resumed, table)
+
+            # tuple options get object columns, also when resumed
+            grid = {'tweezer_options.n_sites': [(2, 2), (3, 3)], 'imaging_time': [5000]}
+            checkpoint = os.path.join(directory, 'sites.jsonl')
+            table = run_sweep(options, grid, evaluate_shots, n_workers=1, seed=12, checkpoint=checkpoint)
+            self.assertEqual(list(table['tweezer_options.n_sites']), [(2, 2), (3, 3)])
+            with open(checkpoint) as f:
+                lines = f.readlines()
+            with open(checkpoint, 'w') as f:
+                f.writelines(lines[:2])
+            resumed = run_sweep(options, grid, evaluate_shots, n_workers=1, seed=12, checkpoint=checkpoint)
+            self.assertEqual(resumed.tolist(), table.tolist())
+
+        # unsupported values fail before any point runs
+        with self.assertRaises(Exception):
+            run_sweep(options, {'atom_options.species': [None]}, evaluate_shots, n_workers=1)
+
+        # misspelled options are not taken for free parameters
+        for key in ['imaging_options.camera_options.gian', 'camera_options.roi']:
+            with self.assertRaises(Exception):
+                run_sweep(options, {key: [1, 2]}, evaluate_shots, n_workers=1)
+
+    def test_layouts(self):
+        options = make_options(n_sites=(6, 5))['tweezer_options']
+        for layout, n_neighbours in [('rectangular', 4), ('triangular', 6), ('hex', 3)]:
+            geometry = simulation.geometry.Tweezers(**options, layout=layout)
+            distances = np.linalg.norm(geometry.positions[:, :, np.newaxis]
+                                       - geometry.positions[:, np.newaxis, :], axis=0)
+
+            # an inner site has its nearest neighbours at one spacing
+            center = geometry.get_flat_index(2, 2)
+            self.assertEqual(np.count_nonzero(np.isclose(distances[center], 25e-6)), n_neighbours)
+            self.assertAlmostEqual(np.min(distances + np.eye(30)), 25e-6)
+
+        # a sparse target keeps only its sites, looked up by (i, j) or flat index
+        target = np.zeros((6, 5), dtype=bool)
+        target[::2, 1:4] = True
+        geometry = simulation.geometry.Tweezers(**options, target=target)
+        self.assertEqual(geometry.positions.shape, (2, 9))
+        flat = geometry.get_flat_index(*np.nonzero(target))
+        np.testing.assert_array_equal(np.sort(flat), np.arange(9))
+        np.testing.assert_array_equal(geometry.get_site_indices(flat), np.nonzero(target))
+        self.assertEqual(geometry.get_flat_index(1, 1), -1)
+        self.assertEqual([tuple(site.indices) for site in geometry.sites], list(zip(*geometry.indices)))
+
+        atoms = simulation.atoms.Atoms(cesium, 50e-6, rng=np.random.default_rng(13))
+        atoms.load_atoms(geometry, 'binomial')
+        geometry.occupancies = atoms.occupancies
+        geometry.set_gt_mask()
+        self.assertFalse(np.any(geometry.gt_mask[~target]))
+        self.assertEqual(np.count_nonzero(geometry.gt_mask), np.count_nonzero(atoms.occupancies))
+
+        # avg_filling of shape n_sites follows the site indices
+        filling = np.zeros((6, 5))
+        filling[4, 3] = 1
+        geometry = simulation.geometry.Tweezers(**dict(options, avg_filling=filling))
+        self.assertEqual(geometry.avg_filling[geometry.get_flat_index(4, 3)], 1)
+        self.assertEqual(np.sum(geometry.avg_filling), 1)
+
+    def test_site_power(self):
+        options = make_options(avg_filling=1)
+        power = np.linspace(8e-3, 20e-3, 16).reshape(4, 4)
+        options['tweezer_options']['power'] = power
+        expt = Experiment(**options, seed=14)
+        geometry, atoms = expt.geometry, expt.atoms
+
+        # every site has the depth and width of a uniform array at its power
+        self.assertEqual(geometry.trap_depth.shape, (16,))
+        self.assertEqual(geometry.sigma_thermal.shape, (2, 16))
+        for i, j in [(0, 0), (3, 2)]:
+            uniform = make_options()
+            uniform['tweezer_options']['power'] = power[i, j]
+            uniform = Experiment(**uniform).geometry
+            site = geometry.get_flat_index(i, j)
+            self.assertAlmostEqual(geometry.trap_depth[site], uniform.trap_depth)
+            np.testing.assert_allclose(geometry.sigma_thermal[:, site], uniform.sigma_thermal)
+
+        # photons spread around every atom by the width of its site
+        expt.load_atoms()
+        photons = atoms.generate_photons(1, geometry.sigma_thermal, 4000)
+        spread = np.std(photons.reshape(2, 16, -1), axis=2)
+        np.testing.assert_allclose(spread, geometry.sigma_thermal[:, atoms.atom_sites], rtol=0.1)
+
+        chunks = atoms.generate_photon_chunks(1, geometry.sigma_thermal, 4000, chunk_size=3000)
+        spread = np.std(np.concatenate(list(chunks), axis=1).reshape(2, 16, -1), axis=2)
+        np.testing.assert_allclose(spread, geometry.sigma_thermal[:, atoms.atom_sites], rtol=0.1)
+
+        # expected images sum the spots of every site
+        camera = expt.imaging.camera
+        sigma = atoms.get_atom_sigma(expt.get_spot_sigma())
+        expected = camera.get_expected_photons(atoms.atom_positions, 100, sigma)
+        single = [camera.get_expected_photons(atoms.atom_positions[:, [k]], 100, sigma[:, k]) for k in range(16)]
+        np.testing.assert_allclose(expected, np.sum(single, axis=0), atol=1e-9)
+
+        frames, masks = expt.generate_shots(4, 15000)
+        self.assertTrue(np.all(masks))
+        self.assertEqual(expt.predict_fidelity(15000, p_filled=0.5)['fidelity'].shape, (4, 4))
+
+        # a per-site power that no longer fits the sites leaves the experiment as it was
+        with self.assertRaises(Exception):
+            expt.update({'tweezer_options.n_sites': (3, 5)})
+        self.assertEqual(expt.options['tweezer_options']['n_sites'], (4, 4))
+        self.assertEqual(geometry.trap_depth.shape, (16,))
+        self.assertEqual(geometry.gt_mask.shape, (4, 4))
+
+        # lists work as arrays, and the same power everywhere acts as a scalar
+        expt.update({'tweezer_options.power': power.tolist()})
+        self.assertEqual(geometry.trap_depth.shape, (16,))
+        expt.update({'tweezer_options.power': [[10e-3]*4]*4})
+        self.assertEqual(np.ndim(geometry.trap_depth), 0)
+        self.assertIsInstance(geometry.sigma_thermal, tuple)
+        expt.update({'tweezer_options.power': 10e-3})
+        self.assertEqual(np.shape(geometry.sigma_thermal), (2,))
+
+    def test_update(self):
+        expt = Experiment(**make_options(), seed=11)
+        bins = expt.imaging.camera.pixel_bins
+
+        # a camera setting only looks up the camera specs
+        steps = expt.update({'imaging_options.camera_options.readout_rate': 1e6})
+        self.assertEqual(steps, ['readout'])
+        self.assertIs(expt.imaging.camera.pixel_bins, bins)
+
+        steps = expt.update({'tweezer_options.power': 20e-3, 'atom_options.temperature': 20e-6})
+        self.assertEqual(steps, ['temperature', 'tweezer_laser', 'trap_depth', 'sigma_thermal'])
+
+        steps = expt.update({'tweezer_options.n_sites': (3, 5), 'imaging_options.optics_options': {
+            'magnification': 5, 'NA': 0.5}})
+        self.assertEqual(steps, ['sites', 'trap_depth', 'sigma_thermal', 'magnification', 'aperture', 'diffraction',
+                                 'rates', 'scale'])
+
+        # a failing update leaves the experiment as it was
+        options = copy_options(expt.options)
+        sensitivity = expt.imaging.camera.sensitivity
+        with self.assertRaises(Exception):
+            expt.update({'imaging_options.camera_options.gain': 300, 'imaging_options.camera_options.colour': 'red'})
+        with self.assertRaises(Exception):
+            expt.update({'imaging_options.camera_options.gain': 300, 'imaging_options.camera_options.readout_rate': 7})
+        self.assertEqual(expt.options, options)
+        self.assertEqual(expt.imaging.camera.gain, options['imaging_options']['camera_options']['gain'])
+        self.assertEqual(expt.imaging.camera.sensitivity, sensitivity)
+
+        # the updated experiment matches one built from the same options
+        options = make_options(n_sites=(3, 5))
+        options['imaging_options']['camera_options']['readout_rate'] = 1e6
+        options['tweezer_options']['power'] = 20e-3
+        options['atom_options']['temperature'] = 20e-6
+        options['imaging_options']['optics_options'] = {'magnification': 5, 'NA': 0.5}
+        fresh = Experiment(**options)
+        self.assertEqual(expt.options, fresh.options)
+
+        images = []
+        for experiment in [expt, fresh]:
+            experiment.set_seed(12)
+            experiment.load_atoms()
+            experiment.image_atoms(15000, mode='expected')
+            images.append(experiment.imaging.camera.image)
+            np.testing.assert_array_equal(experiment.geometry.gt_mask.shape, (3, 5))
+        np.testing.assert_array_equal(images[0], images[1])
+        self.assertEqual(expt.geometry.sigma_thermal, fresh.geometry.sigma_thermal)
+        self.assertEqual(expt.imaging.camera.sensitivity, fresh.imaging.camera.sensitivity)
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of streaming.DetectionStream.
+"""
+
+import asyncio
+import unittest
+import numpy as np
+from .test_detection import make_lattice_image, make_bot
+from tweezerlyze.streaming import DetectionStream, acquire_frames
+
+
+def make_stream(n_frames, n_buffer=4, policy='block'):
+    rng = np.random.default_rng(3)
+    masks = rng.random((n_frames, 5, 5)) > 0.5
+    frames = [make_lattice_image(m, seed=k) for k, m in enumerate(masks)]
+    
+    bot = make_bot()
+    bot.set_site_weights((5, 5), sigma=1.5, shape=frames[0].shape)
+    stream = DetectionStream(bot, threshold=550, n_buffer=n_buffer, policy=policy)
+    
+    return stream, frames, masks
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_run(self):
+        stream, frames, masks = make_stream(10)
+        
+        for k, (timestamp, mask) in enumerate(stream.run((float(k), f) for k, f in enumerate(frames))):
+            self.assertEqual(timestamp, k)
+            np.testing.assert_array_equal(mask, masks[k])
+            
+        self.assertEqual(stream.frames_processed, 10)
+        self.assertEqual(stream.frames.shape, (4, 50, 50))
+
+    def test_acquire_frames(self):
+        stream, frames, masks = make_stream(10)
+        
+        # every frame comes from a new acquisition
+        acquired = acquire_frames(iter(frames).__next__, n_frames=6)
+        for k, (timestamp, mask) in enumerate(stream.run(acquired)):
+            np.testing.assert_array_equal(mask, masks[k])
+        
+        self.assertEqual(stream.frames_processed, 6)
+        
+    def test_arun_drop(self):
+        stream, frames, masks = make_stream(10, policy='drop')
+        results = asyncio.run(consume(stream, source(frames)))
+        
+        # the source fills the buffer while the first frame is classified, so
+        # the oldest pending frames make way for the newest
+        self.assertEqual(stream.frames_received, 10)
+        self.assertEqual(stream.frames_dropped, 6)
+        self.assertEqual(stream.frames_processed + stream.frames_dropped, 10)
+        self.assertEqual(len(results), stream.frames_processed)
+        self.assertEqual([k for k, _, _ in results], [0, 7, 8, 9])
+        for k, mask, _ in results:
+            np.testing.assert_array_equal(mask, masks[k])
+            
+    def test_arun_block(self):
+        stream, frames, masks = make_stream(10, policy='block')
+        results = asyncio.run(consume(stream, source(frames)))
+        
+        # the source is held back once the frame being handled and the pending
+        # frames fill the buffer, so nothing is lost
+        self.assertEqual(stream.frames_dropped, 0)
+        self.assertEqual([k for k, _, _ in results], list(range(10)))
+        self.assertEqual(max(ahead for _, _, ahead in results), 3)
+        for k, mask, _ in results:
+            np.testing.assert_array_equal(mask, masks[k])
+
+
+async def source(frames):
+    for k, frame in enumerate(frames):
+        yield float(k), frame
+        await asyncio.sleep(0)
+
+
+async def consume(stream, frames):
+    """
+    Slow consumer, recording how many frames the source has read ahead while
+    a frame is being handled.
+    """
+    results = []
+    async for timestamp, mask in stream.arun(frames):
+        mask = mask.copy()
+        await asyncio.sleep(0.01)
+        results.append((int(timestamp), mask, stream.frames_received - stream.frames_processed))
+    return results
+
+if __name__ == '__main__':
+    unittest.main()